@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 import os
 from celery import Celery
+from celery.signals import worker_init
 from django.conf import settings
 import logging
 
@@ -19,6 +20,16 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
 
 
+@worker_init.connect
+def load_task_hooks(**kwargs):
+    """
+    Task duration and failure metrics, task profiling. Only workers load them here, web processes import
+    hub.metrics and hub.profiling with the views and middleware.
+    """
+    import hub.metrics  # noqa
+    import hub.profiling  # noqa
+
+
 @app.task(bind=True)
 def debug_task(self):
     print('Request: {0!r}'.format(self.request))
@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/2.0/ref/settings/
 import os
 import random
 import string
+import sys
 from django.conf import settings
 from celery.schedules import crontab
 
@@ -48,6 +49,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'hub.middleware.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -55,6 +57,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'hub.middleware.ProfilingMiddleware',
+    'hub.middleware.ReplicaRoutingMiddleware',
 ]
 
 ROOT_URLCONF = 'ClimateBox.urls'
@@ -92,6 +96,23 @@ DATABASES = {
     }
 }
 
+# Read replica, e.g. a streaming replica of db or any second database for local testing.
+# Test runs always have one, mirroring the test database.
+if os.environ.get('DATABASE_REPLICA_HOST') or sys.argv[1:2] == ['test']:
+    DATABASES['replica'] = dict(DATABASES['default'],
+                                HOST=os.environ.get('DATABASE_REPLICA_HOST', DATABASES['default']['HOST']),
+                                TEST={'MIRROR': 'default'})
+
+DATABASE_ROUTERS = ['hub.routers.ReplicaRouter']
+REPLICA_DATABASES = [alias for alias in DATABASES if alias != 'default']
+REPLICA_READ_PATHS = ('/api/',)  # Safe requests to these paths read from replicas
+REPLICA_MAX_LAG = 5  # Replicas lagging more (s) are not used
+REPLICA_LAG_CHECK_INTERVAL = 5  # s
+REPLICA_STICKY_SECONDS = 10  # Clients read from the primary this long after a write
+
+# JSON responses are compressed with brotli when the brotli package is installed, gzip otherwise
+COMPRESSION_LEVEL = {'br': 5, 'gzip': 6}
+
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
 
@@ -151,17 +172,42 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'Europe/Moscow'
 
+# All periodic tasks. They are single-flight (hub.locks): a run due while the previous one is still
+# in progress is skipped, so the intervals only bound how stale the results get.
 CELERY_BEAT_SCHEDULE = {
     'check_devices': {
-        'task': 'hub.tasks.check_devices',
-        'schedule': crontab()
+        'task': 'check_devices',
+        'schedule': crontab(minute='*/5')  # Devices sleep 5 min by default
     }, 'remove_old_alerts': {
-        'task': 'hub.tasks.remove_old_alerts',
-        'schedule': crontab()
+        'task': 'remove_old_alerts',
+        'schedule': crontab(minute=0)  # Alerts are kept for 24 h, hourly cleanup is precise enough
+    }, 'detect_anomalies': {
+        'task': 'detect_anomalies',
+        'schedule': crontab(minute='*/30')
+    }, 'calculate_averages': {
+        'task': 'calculate_averages',
+        'schedule': crontab(hour=23, minute=58)
+    }, 'calculate_uptime': {
+        'task': 'calculate_uptime',
+        'schedule': crontab(hour=0, minute=30)
+    }, 'forecast_battery': {
+        'task': 'forecast_battery',
+        'schedule': crontab(hour=3, minute=0)
+    }, 'rollup_areas': {
+        'task': 'rollup_areas',
+        'schedule': crontab(minute='*/10')  # Keeps the current hour of building overviews fresh
+    }, 'resume_decommissions': {
+        'task': 'resume_decommissions',
+        'schedule': crontab(minute='*/5')  # Picks up decommission jobs of workers that died
     }
-
 }
 
+# History aggregated per building and floor on the first rollup_areas run
+AREA_ROLLUP_BACKFILL_DAYS = 365
+
+# Lease of a running periodic task in seconds, renewed every third of it while the task runs
+TASK_LEASE_TTL = 300
+
 import os
 
 LOGGING = {
@@ -186,6 +232,18 @@ LOGGING = {
 
 LOGIN_REDIRECT_URL = 'index'
 
+# Sampling profiler for requests and Celery tasks (profiles are browsable in the admin)
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', '').lower() in ('1', 'true', 'yes')
+PROFILING_SAMPLE_RATE = 0.01  # Fraction of requests and tasks stored regardless of their duration
+PROFILING_SLOW_THRESHOLD = 2.0  # Requests and tasks slower than this (s) are always stored
+PROFILING_INTERVAL = 0.005  # Stack sampling interval (s)
+
+# Cold start budget in seconds for django.setup() of web and worker processes (manage.py benchmark_startup)
+STARTUP_TIME_BUDGET = {
+    'web': float(os.getenv('STARTUP_TIME_BUDGET_WEB', 1.5)),
+    'worker': float(os.getenv('STARTUP_TIME_BUDGET_WORKER', 2.5)),
+}
+
 # CONFIGURABLE
 
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
@@ -198,10 +256,43 @@ EMAIL_PORT = 'HIDDEN'
 # Secret key for device registration
 HUB_SECRET_KEY_LENGTH = 6
 
+# Runtime state shared by all processes (hub.state) is kept in this Redis database, set None to keep it in the
+# database (RuntimeValue table) instead
+RUNTIME_STATE_REDIS_URL = 'redis://redis:6379/1'
+RUNTIME_STATE_PREFIX = 'climatebox'
+
 # Default sleep time in ms
 DEVICE_DEFAULT_SLEEP_TIME = 300000  # 5 min
 DEVICE_NIGHT_SLEEP_TIME = 1800000  # 60 min
 
+# Ingest gateway (manage.py run_ingest_gateway): uploads are stored in bulk inserts of up to
+# INGEST_BATCH_SIZE uploads, collected for at most INGEST_BATCH_DELAY seconds
+INGEST_BATCH_SIZE = 200
+INGEST_BATCH_DELAY = 0.05
+
+# UDP readout listener (manage.py run_udp_ingest), datagrams are signed with this key
+UDP_INGEST_KEY = 'HIDDEN'
+UDP_INGEST_PORT = 8002
+UDP_INGEST_WINDOW = 600  # Records older or newer than this (s) are dropped, so they can not be replayed
+
+# Devices per subtask of sharded periodic tasks (calculate_averages, check_devices), split by location
+PERIODIC_TASK_SHARD_SIZE = 50
+
+# Anomaly detection
+ANOMALY_WINDOW_HOURS = 72  # History used for z-scores and trends
+ANOMALY_Z_THRESHOLD = 4.0  # Newest readout deviation in standard deviations
+ANOMALY_FLATLINE_HOURS = 6  # Sensor is considered stuck after this time without changes
+ANOMALY_FLATLINE_EPSILON = 0.05  # °C
+ANOMALY_TREND_THRESHOLD = 1.0  # °C per day
+
+# Device is considered offline after UPTIME_GAP_FACTOR expected sleep periods without readouts
+UPTIME_GAP_FACTOR = 2.5
+
+# Battery depletion forecast
+BATTERY_FORECAST_WINDOW_DAYS = 14  # Charge history used to fit the discharge curve
+BATTERY_FORECAST_ALERT_DAYS = 3  # Raise a battery alert this many days before the predicted depletion
+BATTERY_EMPTY_LEVEL = 0.1  # Battery level (%) considered empty
+
 # Building management email
 SERVICE_EMAIL = "HIDDEN"
 
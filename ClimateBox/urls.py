@@ -17,26 +17,53 @@ Including another URLconf
 # Serializers define the API representation.
 
 
-from django.conf import settings
 from django.conf.urls import url, include
 from django.contrib import admin
 #from django.urls import path
-from django.utils.crypto import get_random_string
 from rest_framework import routers
-from rest_framework.documentation import include_docs_urls
 import django.contrib.auth.views as auth_views
 
-from ClimateBox.settings import HUB_SECRET_KEY_LENGTH
 from hub import views
 
-# Secret key for device registration
 
-settings.hub_secret_key = get_random_string(length=HUB_SECRET_KEY_LENGTH).upper()
+def lazy_view(factory):
+    """
+    Builds the view returned by :factory: on the first request instead of at import
+    """
+    views = []
+
+    def view(request, *args, **kwargs):
+        if not views:
+            views.append(factory())
+        return views[0](request, *args, **kwargs)
+
+    return view
+
+
+def docs_view():
+    # coreapi and the schema machinery are only needed when someone opens the docs
+    from rest_framework.documentation import get_docs_view
+    return get_docs_view(title='ClimateBox API', public=False)
+
+
+def schemajs_view():
+    from rest_framework.documentation import get_schemajs_view
+    return get_schemajs_view(title='ClimateBox API', public=False)
+
+
+# Same routes as rest_framework.documentation.include_docs_urls
+docs_urls = [
+    url(r'^$', lazy_view(docs_view), name='docs-index'),
+    url(r'^schema.js$', lazy_view(schemajs_view), name='schema-js'),
+]
 
 router = routers.DefaultRouter()
 router.register(r'readouts', views.ReadoutViewSet)
 router.register(r'devices', views.DeviceViewSet)
 router.register(r'alerts', views.AlertViewSet)
+router.register(r'logs', views.LogViewSet)
+router.register(r'analytics', views.AnalyticsViewSet, base_name='analytics')
+router.register(r'buildings', views.BuildingViewSet, base_name='buildings')
 
 urlpatterns = [
     url(r'^accounts/', include('django.contrib.auth.urls')),
@@ -51,7 +78,8 @@ urlpatterns = [
     url(r'^api/', include(router.urls)),
     #url(r'^', include('rest_framework.urls', namespace='rest_framework')),
     url('^api/secret_key', views.secret_key),
-    url(r'^docs/', include_docs_urls(title='ClimateBox API', public=False)),
+    url(r'^docs/', include((docs_urls, 'api-docs'), namespace='api-docs')),
     url('^debug', views.debug_interface),
+    url(r'^metrics$', views.metrics),
 
 ]
@@ -1 +0,0 @@
-from hub.tasks import *
\ No newline at end of file
@@ -1,11 +1,19 @@
+import json
+
 from django.contrib import admin, auth
-from .models import Location, Device, Readout, Alert, Log, AverageReadout
+from django.contrib.admin.views.main import ORDER_VAR, PAGE_VAR
+from django.core.paginator import Paginator
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+from django.utils.html import format_html
+from .models import Location, Device, Readout, Alert, Log, AverageReadout, DeviceUptime, Profile, TaskRun, AreaAggregate, \
+    DecommissionJob
 
 admin.site.register(Location)
-admin.site.register(Readout)
-admin.site.register(Alert)
-admin.site.register(Log)
-admin.site.register(AverageReadout)
+admin.site.register(DeviceUptime)
+admin.site.register(AreaAggregate)
 
 admin.site.site_header = "ClimateBox Admin"
 admin.site.site_title = "ClimateBox"
@@ -20,3 +28,177 @@ class DeviceAdmin(admin.ModelAdmin):
             return ["id", "MAC", "charge", "last_connection", "last_readout", "warning"]
         else:
             return ["id"]
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Uses the planner estimate instead of COUNT(*) for large PostgreSQL querysets
+    """
+    exact_count_limit = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql':
+            sql, params = queryset.query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+                plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            estimate = int(plan[0]['Plan']['Plan Rows'])
+            if estimate > self.exact_count_limit:
+                return estimate
+        return super().count
+
+
+class KeysetChangeListMixin(object):
+    """
+    Pages large changelists with "older than the last shown row" links instead of OFFSET. The link carries
+    the (timestamp, id) of that row, so rows sharing its timestamp are not skipped.
+    """
+    keyset_field = 'timestamp'
+    keyset_var = 'before'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    change_list_template = 'admin/hub/keyset_change_list.html'
+
+    def decode_keyset(self, value):
+        try:
+            timestamp, pk = value.rsplit('|', 1)
+            timestamp, pk = parse_datetime(timestamp), int(pk)
+        except ValueError:
+            return None
+        return (timestamp, pk) if timestamp is not None else None
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        keyset = getattr(request, 'keyset', None)
+        if keyset is not None:
+            timestamp, pk = keyset
+            queryset = queryset.filter(Q(**{'%s__lt' % self.keyset_field: timestamp}) |
+                                       Q(**{self.keyset_field: timestamp, 'id__lt': pk}))
+        return queryset
+
+    def changelist_view(self, request, extra_context=None):
+        # The ChangeList takes unknown GET params for lookups
+        request.GET = request.GET.copy()
+        value = request.GET.pop(self.keyset_var, None)
+        request.keyset = self.decode_keyset(value[-1]) if value else None
+        response = super().changelist_view(request, extra_context)
+        context = getattr(response, 'context_data', None) or {}
+        cl = context.get('cl')
+        if cl is not None and ORDER_VAR not in request.GET:
+            results = list(cl.result_list)
+            if len(results) == cl.list_per_page:
+                last = results[-1]
+                context['next_page_query'] = cl.get_query_string({self.keyset_var: "%s|%d" % (
+                    getattr(last, self.keyset_field).isoformat(sep=' '), last.pk)}, [PAGE_VAR])
+            if request.keyset is not None:
+                context['first_page_query'] = cl.get_query_string(remove=[PAGE_VAR])
+        return response
+
+
+@admin.register(Readout)
+class ReadoutAdmin(KeysetChangeListMixin, admin.ModelAdmin):
+    list_display = ('timestamp', 'location', 'device_display', 'temp', 'CO2', 'humid', 'charge')
+    list_select_related = ('location',)
+    list_filter = ('location',)
+    date_hierarchy = 'timestamp'
+    ordering = ('-timestamp', '-id')
+    raw_id_fields = ('device', 'location')
+
+    def device_display(self, obj):
+        return obj.device_id
+
+    device_display.short_description = 'Устройство'
+
+
+@admin.register(AverageReadout)
+class AverageReadoutAdmin(ReadoutAdmin):
+    pass
+
+
+@admin.register(Log)
+class LogAdmin(KeysetChangeListMixin, admin.ModelAdmin):
+    list_display = ('timestamp', 'type', 'tag', 'message')
+    list_filter = ('type',)
+    date_hierarchy = 'timestamp'
+    ordering = ('-timestamp', '-id')
+
+
+@admin.register(Alert)
+class AlertAdmin(admin.ModelAdmin):
+    list_display = ('timestamp', 'location', 'type', 'critical', 'counter', 'email_sent')
+    list_select_related = ('location',)
+    list_filter = ('type', 'critical', 'email_sent')
+
+
+@admin.register(Profile)
+class ProfileAdmin(admin.ModelAdmin):
+    list_display = ('timestamp', 'kind', 'name', 'duration', 'samples', 'sampled')
+    list_filter = ('kind', 'sampled')
+    search_fields = ('name',)
+    fields = ('timestamp', 'kind', 'name', 'duration', 'samples', 'sampled', 'call_tree_display', 'stacks')
+    readonly_fields = fields
+
+    def call_tree_display(self, obj):
+        return format_html("<pre>{}</pre>", obj.call_tree)
+
+    call_tree_display.short_description = 'Дерево вызовов'
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(TaskRun)
+class TaskRunAdmin(admin.ModelAdmin):
+    list_display = ('name', 'status', 'started', 'finished', 'duration', 'skipped')
+    list_filter = ('status',)
+    readonly_fields = ('name', 'status', 'started', 'finished', 'duration', 'skipped', 'message')
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(DecommissionJob)
+class DecommissionJobAdmin(admin.ModelAdmin):
+    list_display = ('location_name', 'mode', 'status', 'progress_display', 'readouts', 'averages', 'alerts',
+                    'created', 'updated')
+    list_filter = ('status', 'mode')
+    actions = ('start', 'pause')
+    progress_fields = ('location_name', 'status', 'created', 'updated', 'total', 'readouts', 'averages', 'alerts',
+                       'last_timestamp', 'last_id', 'message')
+
+    def get_readonly_fields(self, request, obj=None):
+        if obj is None:
+            return self.progress_fields
+        return ('location', 'mode') + self.progress_fields
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if not change:
+            from hub.tasks import run_decommission
+            transaction.on_commit(lambda: run_decommission.delay(obj.id))
+
+    def progress_display(self, obj):
+        return "%1.1f%%" % obj.progress()
+
+    progress_display.short_description = 'Прогресс'
+
+    def start(self, request, queryset):
+        from hub.tasks import run_decommission
+        jobs = list(queryset.filter(status__in=('q', 'p', 'f')).values_list('id', flat=True))
+        DecommissionJob.objects.filter(id__in=jobs).update(status='q', message='')
+        for job in jobs:
+            transaction.on_commit(lambda job=job: run_decommission.delay(job))
+        self.message_user(request, "Запущено заданий: %d" % len(jobs))
+
+    start.short_description = 'Запустить / продолжить'
+
+    def pause(self, request, queryset):
+        paused = queryset.filter(status__in=('q', 'r')).update(status='p')
+        self.message_user(request, "Приостановлено заданий: %d" % paused)
+
+    pause.short_description = 'Приостановить'
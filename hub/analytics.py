@@ -0,0 +1,143 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+from django.db import connections
+
+from hub.models import Location, Readout
+from hub.routers import read_database
+
+# Grouping level -> columns of hub_location the statistics are grouped by
+groupings = {
+    "location": ("id",),
+    "floor": ("building", "floor"),
+    "building": ("building",),
+}
+
+metrics = ("temp", "humid", "CO2")
+
+PERCENTILE = 0.95
+
+
+def _statistics_sql(keys, source):
+    """
+    Builds a single grouped query computing count/min/max/mean/p95 of every metric per group.
+    :param keys: hub_location columns to group by
+    :param source: "raw" - readouts only, "averages" - daily averages only
+    """
+    columns = ["l.%s" % key for key in keys]
+    selects = list(columns) + ["COUNT(*)"]
+    for metric in metrics:
+        column = 'r."%s"' % metric
+        selects += ["MIN(%s)" % column, "MAX(%s)" % column, "AVG(%s)" % column,
+                    "PERCENTILE_CONT(%s) WITHIN GROUP (ORDER BY %s)" % (PERCENTILE, column)]
+    join = "JOIN" if source == "averages" else "LEFT JOIN"
+    where = "" if source == "averages" else "AND a.readout_ptr_id IS NULL "
+    return "SELECT %s FROM hub_readout r " \
+           "JOIN hub_location l ON l.id = r.location_id " \
+           "%s hub_averagereadout a ON a.readout_ptr_id = r.id " \
+           "WHERE r.timestamp BETWEEN %%s AND %%s %s" \
+           "GROUP BY %s ORDER BY %s" % (", ".join(selects), join, where, ", ".join(columns), ", ".join(columns))
+
+
+def _grouped_percentile(groups, values, q):
+    """
+    Vectorized percentile (linear interpolation, as PERCENTILE_CONT) of values within every group.
+    :param groups: int array of group indices 0..n-1
+    :param values: float array, NaN for missing values
+    :return: array of n percentiles, NaN for groups without values
+    """
+    n = groups.max() + 1 if len(groups) else 0
+    valid = ~np.isnan(values)
+    groups, values = groups[valid], values[valid]
+    order = np.lexsort((values, groups))
+    groups, values = groups[order], values[order]
+    counts = np.bincount(groups, minlength=n)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    result = np.full(n, np.nan)
+    present = counts > 0
+    position = starts[present] + q * (counts[present] - 1)
+    lower = np.floor(position).astype(int)
+    upper = np.ceil(position).astype(int)
+    result[present] = values[lower] + (values[upper] - values[lower]) * (position - lower)
+    return result
+
+
+def _numpy_statistics(keys, source, start_date, end_date):
+    """
+    Fallback for databases without PERCENTILE_CONT: fetches the period once and groups it with NumPy.
+    """
+    queryset = Readout.objects.filter(timestamp__range=[start_date, end_date],
+                                      averagereadout__isnull=(source != "averages"))
+    rows = queryset.values_list(*(["location__%s" % key for key in keys] + list(metrics)))
+    if not rows:
+        return []
+    rows = list(rows)
+    group_keys = [row[:len(keys)] for row in rows]
+    unique_keys = sorted(set(group_keys), key=lambda k: tuple((v is None, v) for v in k))
+    index = {key: i for i, key in enumerate(unique_keys)}
+    groups = np.fromiter((index[key] for key in group_keys), dtype=int, count=len(rows))
+    counts = np.bincount(groups, minlength=len(unique_keys))
+
+    result = [list(key) + [int(count)] for key, count in zip(unique_keys, counts)]
+    for m, metric in enumerate(metrics):
+        values = np.array([row[len(keys) + m] for row in rows], dtype=float)
+        valid = ~np.isnan(values)
+        present = np.bincount(groups[valid], minlength=len(unique_keys))
+        sums = np.bincount(groups[valid], weights=values[valid], minlength=len(unique_keys))
+        minimums = np.full(len(unique_keys), np.inf)
+        maximums = np.full(len(unique_keys), -np.inf)
+        np.minimum.at(minimums, groups[valid], values[valid])
+        np.maximum.at(maximums, groups[valid], values[valid])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums / present
+        percentiles = _grouped_percentile(groups, values, PERCENTILE)
+        for i, row in enumerate(result):
+            if present[i]:
+                row += [minimums[i], maximums[i], means[i], percentiles[i]]
+            else:
+                row += [None, None, None, None]
+    return result
+
+
+def _round(value):
+    return round(float(value), 1) if value is not None else None
+
+
+def location_statistics(group="location", start_date=None, end_date=None, source="raw"):
+    """
+    Min/max/mean/95th percentile of temperature, humidity and CO2 for every group over the period,
+    computed in one grouped query.
+    :param group: one of :groupings: keys
+    :param start_date: beginning of the period
+    :param end_date: end of the period (now by default)
+    :param source: "raw" readouts or daily "averages"
+    :return: list of dicts, one per group
+    """
+    keys = groupings[group]
+    end_date = end_date or datetime.now()
+    start_date = start_date or end_date - timedelta(days=1)
+
+    connection = connections[read_database()]
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute(_statistics_sql(keys, source), [start_date, end_date])
+            rows = cursor.fetchall()
+    else:
+        rows = _numpy_statistics(keys, source, start_date, end_date)
+
+    names = {}
+    if group == "location":
+        names = {location.id: str(location) for location in
+                 Location.objects.filter(id__in=[row[0] for row in rows])}
+
+    statistics = []
+    for row in rows:
+        item = dict(zip(("location_id",) if group == "location" else keys, row[:len(keys)]))
+        if group == "location":
+            item["location"] = names.get(row[0])
+        item["count"] = row[len(keys)]
+        for m, metric in enumerate(metrics):
+            offset = len(keys) + 1 + m * 4
+            item[metric] = dict(zip(("min", "max", "mean", "p95"), map(_round, row[offset:offset + 4])))
+        statistics.append(item)
+    return statistics
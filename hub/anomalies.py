@@ -0,0 +1,149 @@
+import warnings
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from ClimateBox.settings import DEVICE_DEFAULT_SLEEP_TIME, ANOMALY_WINDOW_HOURS, ANOMALY_Z_THRESHOLD, \
+    ANOMALY_FLATLINE_HOURS, ANOMALY_FLATLINE_EPSILON, ANOMALY_TREND_THRESHOLD
+
+
+def load_windows(end_date=None, hours=ANOMALY_WINDOW_HOURS, step=DEVICE_DEFAULT_SLEEP_TIME):
+    """
+    Loads the recent temperature history of all locations in one query and resamples it to a matrix.
+    :param end_date: end of the window (now by default)
+    :param hours: window length
+    :param step: bin width in ms
+    :return: (location ids, bin start times in seconds, locations x bins matrix, NaN where no readout)
+    """
+    from hub.models import Readout
+
+    end_date = end_date or datetime.now()
+    start_date = end_date - timedelta(hours=hours)
+    rows = Readout.objects.filter(timestamp__range=[start_date, end_date], temp__isnull=False,
+                                  averagereadout__isnull=True).order_by().values_list('location_id', 'timestamp',
+                                                                                      'temp')
+    rows = list(rows)
+    step = step / 1000
+    bins = int(np.ceil(hours * 3600 / step))
+    times = np.arange(bins) * step
+    if not rows:
+        return np.array([], dtype=int), times, np.empty((0, bins))
+
+    locations = np.array([row[0] for row in rows])
+    offsets = np.array([(row[1] - start_date).total_seconds() for row in rows])
+    temps = np.array([row[2] for row in rows], dtype=float)
+
+    location_ids, rows_index = np.unique(locations, return_inverse=True)
+    columns = np.clip((offsets // step).astype(int), 0, bins - 1)
+    sums = np.zeros((len(location_ids), bins))
+    counts = np.zeros((len(location_ids), bins))
+    np.add.at(sums, (rows_index, columns), temps)
+    np.add.at(counts, (rows_index, columns), 1)
+    with np.errstate(invalid='ignore'):
+        matrix = sums / counts
+    return location_ids, times, matrix
+
+
+def _last_valid(matrix):
+    """
+    The newest non-NaN value of every row (NaN if the row is empty).
+    """
+    valid = ~np.isnan(matrix)
+    last = matrix.shape[1] - 1 - np.argmax(valid[:, ::-1], axis=1)
+    values = matrix[np.arange(matrix.shape[0]), last]
+    values[~valid.any(axis=1)] = np.nan
+    return values
+
+
+def zscores(matrix):
+    """
+    Z-score of the newest readout of every location against the rest of its window.
+    """
+    last = _last_valid(matrix)
+    history = matrix.copy()
+    valid = ~np.isnan(history)
+    last_column = history.shape[1] - 1 - np.argmax(valid[:, ::-1], axis=1)
+    history[np.arange(history.shape[0]), last_column] = np.nan
+    with _silent():
+        mean = np.nanmean(history, axis=1)
+        std = np.nanstd(history, axis=1)
+        return (last - mean) / std
+
+
+def flatlines(matrix, step=DEVICE_DEFAULT_SLEEP_TIME, hours=ANOMALY_FLATLINE_HOURS,
+              epsilon=ANOMALY_FLATLINE_EPSILON, heartbeats=None):
+    """
+    Stuck sensors: the last :hours: are all within :epsilon: and cover at least half of the expected readouts.
+    :param heartbeats: deadband heartbeat in seconds for every row, 0 for full locations. A deadband location
+                       stores a readout per heartbeat while nothing changes, so a stuck sensor leaves only these.
+    """
+    width = int(np.ceil(hours * 3600 / (step / 1000)))
+    tail = matrix[:, -width:]
+    present = (~np.isnan(tail)).sum(axis=1)
+    required = np.full(len(matrix), width / 2)
+    if heartbeats is not None:
+        deadband = heartbeats > 0
+        required[deadband] = np.maximum(hours * 3600 / heartbeats[deadband] / 2, 2)
+    with _silent():
+        spread = np.nanmax(tail, axis=1) - np.nanmin(tail, axis=1)
+    return (present >= required) & (spread <= epsilon)
+
+
+def trends(matrix, times):
+    """
+    Least squares slope of every row in °C per day, NaN readouts ignored.
+    """
+    valid = ~np.isnan(matrix)
+    n = valid.sum(axis=1)
+    t = np.where(valid, times, 0.0)
+    y = np.where(valid, matrix, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t_mean = t.sum(axis=1) / n
+        y_mean = y.sum(axis=1) / n
+        dt = np.where(valid, times - t_mean[:, None], 0.0)
+        dy = np.where(valid, matrix - y_mean[:, None], 0.0)
+        slope = (dt * dy).sum(axis=1) / (dt * dt).sum(axis=1)
+    slope[n < 2] = np.nan
+    return slope * 86400
+
+
+@contextmanager
+def _silent():
+    """
+    Silences "mean of empty slice" warnings of rows without readouts.
+    """
+    with np.errstate(all='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        yield
+
+
+def detect(end_date=None):
+    """
+    Runs every detector over the whole fleet at once.
+    :return: dict location id -> list of anomaly descriptions
+    """
+    from hub.models import Location
+
+    location_ids, times, matrix = load_windows(end_date)
+    anomalies = {}
+    if not len(location_ids):
+        return anomalies
+
+    heartbeats = dict(Location.objects.filter(id__in=location_ids.tolist(), deadband=True)
+                      .values_list('id', 'deadband_heartbeat'))
+    z = zscores(matrix)
+    stuck = flatlines(matrix, heartbeats=np.array([heartbeats.get(location_id, 0) for location_id in location_ids],
+                                                  dtype=float))
+    slope = trends(matrix, times)
+
+    for i in np.flatnonzero(np.abs(np.nan_to_num(z)) > ANOMALY_Z_THRESHOLD):
+        anomalies.setdefault(int(location_ids[i]), []).append(
+            "резкое изменение температуры (z = %1.1f)" % z[i])
+    for i in np.flatnonzero(stuck):
+        anomalies.setdefault(int(location_ids[i]), []).append(
+            "показания датчика не меняются более %d ч" % ANOMALY_FLATLINE_HOURS)
+    for i in np.flatnonzero(np.abs(np.nan_to_num(slope)) > ANOMALY_TREND_THRESHOLD):
+        anomalies.setdefault(int(location_ids[i]), []).append(
+            "температура %s на %1.1f°C в сутки" % ("растёт" if slope[i] > 0 else "падает", abs(slope[i])))
+    return anomalies
@@ -0,0 +1,167 @@
+"""
+Replays the alert rules of process_readout over stored readouts without writing any Alert:
+- a readout deviating from the season norm by more than max_temp_deviation raises the temperature alert
+  of its location, by more than three times that it is critical;
+- the alert is created non-critical, every later readout sets it to its own criticality (an escalation
+  when it turns critical);
+- a critical readout on an alert that is critical already sends an email, once per alert;
+- remove_old_alerts deletes an alert 24 hours after its last readout, the next one creates a new alert;
+- a battery alert is raised by a readout at or below BATTERY_EMPTY_LEVEL and removed by one above it.
+Live only the newest readout of an upload is evaluated, here every stored readout is.
+"""
+from datetime import datetime
+
+import numpy as np
+from django.db import connections
+
+from ClimateBox.settings import BATTERY_EMPTY_LEVEL
+from hub.routers import use_replica, read_database
+
+ALERT_LIFETIME = 24 * 3600  # s, see remove_old_alerts
+
+READOUTS_SQL = """
+SELECT r.location_id, COALESCE(r.device_id, 0), EXTRACT(EPOCH FROM r.timestamp), r.temp, r.charge
+FROM hub_readout r
+LEFT JOIN hub_averagereadout a ON a.readout_ptr_id = r.id
+WHERE a.readout_ptr_id IS NULL AND r.temp IS NOT NULL AND r.timestamp BETWEEN %s AND %s {locations}
+ORDER BY r.location_id, r.timestamp
+"""
+
+
+def load_readouts(start_date, end_date, location_ids=None):
+    """
+    Loads the raw readouts with a temperature of the period in one query.
+    :return: (location ids, device ids, timestamps in seconds, temperatures, charges) arrays,
+             sorted by location and time
+    """
+    from hub.models import Readout
+
+    connection = connections[read_database()]
+    if connection.vendor == "postgresql":
+        params = [start_date, end_date]
+        locations = ""
+        if location_ids:
+            locations = "AND r.location_id = ANY(%s)"
+            params.append(list(location_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(READOUTS_SQL.format(locations=locations), params)
+            rows = np.array(cursor.fetchall(), dtype=float).reshape(-1, 5)
+    else:
+        readouts = Readout.objects.filter(timestamp__range=[start_date, end_date], temp__isnull=False,
+                                          averagereadout__isnull=True)
+        if location_ids:
+            readouts = readouts.filter(location_id__in=location_ids)
+        epoch = datetime(1970, 1, 1)
+        rows = np.array([(location, device or 0, (timestamp - epoch).total_seconds(), temp, charge)
+                         for location, device, timestamp, temp, charge in
+                         readouts.order_by('location_id', 'timestamp').values_list(
+                             'location_id', 'device_id', 'timestamp', 'temp', 'charge')], dtype=float).reshape(-1, 5)
+    return rows[:, 0].astype(int), rows[:, 1].astype(int), rows[:, 2], rows[:, 3], rows[:, 4]
+
+
+def season_norms(seconds, warm_norm, cold_norm):
+    """
+    Normal temperature at every timestamp, see tasks.season
+    """
+    months = seconds.astype('datetime64[s]').astype('datetime64[M]').astype(int) % 12 + 1
+    return np.where(np.isin(months, [1, 2, 3, 10, 11, 12]), cold_norm, warm_norm)
+
+
+def temperature_alerts(seconds, temps, norms, max_deviation, lifetime=ALERT_LIFETIME):
+    """
+    Temperature alerts of one location.
+    :param seconds: readout timestamps, ascending
+    :return: dict with the numbers of "alerts", "escalations" and "emails" and the "episodes" - one
+             (start, end, readouts, escalations, email time or None) tuple per alert, times in seconds
+    """
+    deviations = np.abs(temps - norms)
+    outside = np.flatnonzero(deviations > max_deviation)
+    if not len(outside):
+        return {"alerts": 0, "escalations": 0, "emails": 0, "episodes": []}
+    times = seconds[outside]
+    critical = deviations[outside] > max_deviation * 3
+
+    # A new alert whenever the previous one expired
+    starts = np.ones(len(outside), dtype=bool)
+    starts[1:] = np.diff(times) > lifetime
+    episodes = np.cumsum(starts) - 1
+    firsts = np.flatnonzero(starts)
+    lasts = np.append(firsts[1:], len(outside)) - 1
+    positions = np.arange(len(outside)) - firsts[episodes]
+
+    # Criticality of the alert before each readout: False after creation, then the one of the previous readout
+    was_critical = np.zeros(len(outside), dtype=bool)
+    was_critical[1:] = critical[:-1]
+    was_critical[positions < 2] = False
+    escalations = (positions >= 1) & critical & ~was_critical
+    candidates = np.flatnonzero((positions >= 1) & critical & was_critical)
+    emailed, first_emails = np.unique(episodes[candidates], return_index=True)
+    email_times = np.full(len(firsts), np.nan)
+    email_times[emailed] = times[candidates[first_emails]]
+
+    readouts = np.bincount(episodes)
+    episode_escalations = np.bincount(episodes, weights=escalations).astype(int)
+    return {
+        "alerts": len(firsts),
+        "escalations": int(escalations.sum()),
+        "emails": len(emailed),
+        "episodes": [(float(times[first]), float(times[last]), int(count), int(escalated),
+                      None if np.isnan(email) else float(email))
+                     for first, last, count, escalated, email in
+                     zip(firsts, lasts, readouts, episode_escalations, email_times)]
+    }
+
+
+def battery_alerts(seconds, levels, lifetime=ALERT_LIFETIME):
+    """
+    :param levels: battery level (%) at every readout of a location, ascending in time
+    :return: number of battery alerts created
+    """
+    empty = levels <= BATTERY_EMPTY_LEVEL
+    # The alert of the previous readout is still there if it was empty and not too long ago
+    alive = np.zeros(len(levels), dtype=bool)
+    alive[1:] = empty[:-1] & (np.diff(seconds) <= lifetime)
+    return int((empty & ~alive).sum())
+
+
+def backtest(start_date, end_date, location_ids=None, max_temp_deviation=None, warm_season_normal_temp=None,
+             cold_season_normal_temp=None):
+    """
+    Replays the alert rules over the readouts of a period. Location settings can be overridden to see the
+    effect of a change.
+    :return: {location: dict of temperature_alerts plus "battery_alerts" and "readouts"}
+    """
+    from hub.models import Location, Device
+
+    locations = Location.objects.all()
+    if location_ids:
+        locations = locations.filter(id__in=location_ids)
+    capacities = dict(Device.objects.values_list('id', 'battery_capacity'))
+    with use_replica():
+        location_index, devices, seconds, temps, charges = load_readouts(start_date, end_date, location_ids)
+
+    # Battery level as Device.battery_level computes it, -1 for an unknown capacity
+    capacity = np.full(max(list(capacities) + [int(devices.max()) if len(devices) else 0]) + 1, np.nan)
+    for device, device_capacity in capacities.items():
+        if device_capacity:
+            capacity[device] = device_capacity
+    capacity = capacity[devices]
+    levels = np.where(np.isnan(capacity), -1, charges / capacity * 100)
+
+    ids, firsts, counts = np.unique(location_index, return_index=True, return_counts=True)
+    bounds = {location_id: slice(first, first + count) for location_id, first, count in zip(ids, firsts, counts)}
+    report = {}
+    for location in locations:
+        rows = bounds.get(location.id, slice(0, 0))
+        norms = season_norms(seconds[rows],
+                             location.warm_season_normal_temp if warm_season_normal_temp is None
+                             else warm_season_normal_temp,
+                             location.cold_season_normal_temp if cold_season_normal_temp is None
+                             else cold_season_normal_temp)
+        result = temperature_alerts(seconds[rows], temps[rows], norms,
+                                    location.max_temp_deviation if max_temp_deviation is None
+                                    else max_temp_deviation)
+        result["battery_alerts"] = battery_alerts(seconds[rows], levels[rows])
+        result["readouts"] = len(seconds[rows])
+        report[location] = result
+    return report
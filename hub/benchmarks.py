@@ -0,0 +1,92 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+
+# Loaded on demand by web processes, see StartupTimeTest. django.core.mail and django.template.loader are
+# not listed: django.contrib.auth's admin forms import them during admin autodiscovery.
+WEB_LAZY_MODULES = ('hub.tasks', 'hub.locks', 'hub.metrics', 'hub.profiling', 'celery.task', 'numpy')
+
+# Runs in a fresh interpreter so nothing is imported beforehand
+STARTUP_SCRIPT = """
+import json
+import os
+import sys
+import time
+
+start = time.perf_counter()
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ClimateBox.settings")
+import django
+django.setup()
+process = sys.argv[1]
+if process == "worker":
+    from ClimateBox.celery import app
+    app.loader.import_default_modules()
+setup = time.perf_counter() - start
+loaded = [name for name in json.loads(sys.argv[2]) if name in sys.modules]
+
+start = time.perf_counter()
+if process == "web":
+    from wsgiref.util import setup_testing_defaults
+    from django.core.handlers.wsgi import WSGIHandler
+    environ = {"PATH_INFO": "/accounts/login/", "HTTP_HOST": "127.0.0.1"}
+    setup_testing_defaults(environ)
+    WSGIHandler()(environ, lambda status, headers: None)
+else:
+    app.tasks["ClimateBox.celery.debug_task"].apply()
+first_request = time.perf_counter() - start
+
+print(json.dumps({"setup": setup, "first_request": first_request, "modules": len(sys.modules), "loaded": loaded}))
+"""
+
+
+def measure_startup(process="web"):
+    """
+    Measures a cold start of a web or worker process in a separate interpreter.
+    :param process: "web" - django.setup() and the first request through the WSGI handler,
+                    "worker" - django.setup() with task autodiscovery and the first task
+    :return: dict with "setup" and "first_request" times in seconds, the number of imported "modules" and
+             the WEB_LAZY_MODULES "loaded" by the setup
+    """
+    output = subprocess.check_output([sys.executable, "-c", STARTUP_SCRIPT, process, json.dumps(WEB_LAZY_MODULES)],
+                                     cwd=settings.BASE_DIR,
+                                     env=dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get(
+                                         "DJANGO_SETTINGS_MODULE", "ClimateBox.settings")))
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def benchmark_serializers(count=5000, runs=5):
+    """
+    Times the readout list output through ReadoutListSerializer and JSONRenderer against the values_list path
+    (hub.renderers.representation and render_json) on the latest :count: readouts.
+    :return: dict with the best "serializer" and "fast" times in seconds (query included), the number of "rows"
+             and whether both outputs are "identical"
+    """
+    from rest_framework.renderers import JSONRenderer
+    from hub.models import Readout
+    from hub.renderers import representation, render_json
+    from hub.serializers import ReadoutListSerializer
+
+    fields = ReadoutListSerializer.Meta.fields
+    # Ties on the timestamp are ordered by id, so both paths output the rows in the same order
+    ordering = ('-timestamp', '-id')
+    ids = list(Readout.objects.order_by(*ordering).values_list('id', flat=True)[:count])
+    queryset = Readout.objects.filter(id__in=ids).order_by(*ordering)
+    paths = {
+        "serializer": lambda: JSONRenderer().render(ReadoutListSerializer(queryset.all(), many=True).data),
+        "fast": lambda: render_json(representation(queryset.values_list(*fields), fields))
+    }
+    result = {"rows": len(ids)}
+    outputs = {}
+    for name, path in paths.items():
+        best = float('inf')
+        for _ in range(runs):
+            start = time.perf_counter()
+            outputs[name] = path()
+            best = min(best, time.perf_counter() - start)
+        result[name] = best
+    result["identical"] = outputs["serializer"] == outputs["fast"]
+    return result
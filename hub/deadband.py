@@ -0,0 +1,120 @@
+"""
+Deadband storage: for locations with Location.deadband set a readout is stored only when temperature,
+humidity or CO2 moves beyond the location thresholds from the last stored readout, or when
+deadband_heartbeat seconds passed since it. A stored value therefore holds until the next stored one.
+"""
+from datetime import timedelta
+
+from django.db import connection
+
+from hub.models import Readout
+
+# Latest raw readout of every device, an index scan per device
+LAST_STORED_SQL = """
+SELECT last.* FROM unnest(%s::int[]) AS device(id) CROSS JOIN LATERAL (
+    SELECT r.* FROM hub_readout r
+    WHERE r.device_id = device.id
+      AND NOT EXISTS (SELECT 1 FROM hub_averagereadout a WHERE a.readout_ptr_id = r.id)
+    ORDER BY r.timestamp DESC LIMIT 1
+) AS last
+"""
+
+thresholds = (('temp', 'deadband_temp'), ('humid', 'deadband_humid'), ('CO2', 'deadband_CO2'))
+
+
+def last_stored(device_ids):
+    """
+    :return: {device id: latest stored raw Readout}
+    """
+    if connection.vendor == 'postgresql':
+        readouts = Readout.objects.raw(LAST_STORED_SQL, [list(device_ids)])
+    else:
+        readouts = [Readout.objects.filter(device_id=device_id, averagereadout__isnull=True).first()
+                    for device_id in device_ids]
+    return {readout.device_id: readout for readout in readouts if readout is not None}
+
+
+def changed(reference, readout, location):
+    """
+    :return: whether :readout: has to be stored after :reference:
+    """
+    if (readout.timestamp - reference.timestamp).total_seconds() >= location.deadband_heartbeat:
+        return True
+    for field, threshold in thresholds:
+        value, stored = getattr(readout, field), getattr(reference, field)
+        if (value is None) != (stored is None):
+            return True
+        if value is not None and abs(value - stored) > getattr(location, threshold):
+            return True
+    return False
+
+
+def deadband_filter(readouts):
+    """
+    Drops the readouts of deadband locations that repeat the last stored value.
+    Readouts not newer than the last stored one are kept, the insert sorts out the duplicates among them.
+    :return: (readouts to store, dropped readouts)
+    """
+    devices = {readout.device_id for readout in readouts if readout.location.deadband}
+    if not devices:
+        return readouts, []
+    references = last_stored(devices)
+    stored, dropped = [], []
+    for readout in sorted(readouts, key=lambda readout: readout.timestamp):
+        reference = references.get(readout.device_id)
+        if not readout.location.deadband or reference is None or (
+                readout.timestamp > reference.timestamp and changed(reference, readout, readout.location)):
+            stored.append(readout)
+            if readout.location.deadband:
+                references[readout.device_id] = readout
+        elif readout.timestamp <= reference.timestamp:
+            stored.append(readout)
+        else:
+            dropped.append(readout)
+    return stored, dropped
+
+
+def step_series(rows, previous=None, start=None, end=None):
+    """
+    Rebuilds the series of a deadband location for plotting: a copy of the previous values is added a second
+    before every change, the :previous: row (stored before the period) is moved to :start: and the last row
+    is repeated at :end:.
+    :param rows: tuples starting with the timestamp, newest first
+    :return: tuples newest first
+    """
+    rows = list(reversed(rows))
+    if previous is not None:
+        rows.insert(0, (start,) + tuple(previous[1:]))
+    if rows and end is not None and rows[-1][0] < end:
+        rows.append((end,) + tuple(rows[-1][1:]))
+    series = []
+    for row in rows:
+        if series and row[1:] != series[-1][1:] and row[0] - series[-1][0] > timedelta(seconds=1):
+            series.append((row[0] - timedelta(seconds=1),) + tuple(series[-1][1:]))
+        series.append(row)
+    series.reverse()
+    return series
+
+
+def time_weighted_means(rows, end, max_hold, previous=None, start=None):
+    """
+    Means in which every value counts for the time it held: until the next row, :end: or :max_hold: seconds,
+    whichever comes first (at least a second).
+    :param rows: (timestamp, value, ...) tuples, oldest first
+    :param previous: row before :start: whose values held at :start:
+    :return: list of means of the value columns, None where all values are None
+    """
+    rows = list(rows)
+    if previous is not None and (start - previous[0]).total_seconds() < max_hold:
+        rows.insert(0, (start,) + tuple(previous[1:]))
+    if not rows:
+        return []
+    sums = [0.0] * (len(rows[0]) - 1)
+    weights = [0.0] * len(sums)
+    for row, following in zip(rows, [row[0] for row in rows[1:]] + [end]):
+        weight = min(max((following - row[0]).total_seconds(), 1), max_hold)
+        for i, value in enumerate(row[1:]):
+            if value is not None:
+                sums[i] += value * weight
+                weights[i] += weight
+    return [total / weight if weight else None for total, weight in zip(sums, weights)]
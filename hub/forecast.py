@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from ClimateBox.settings import BATTERY_FORECAST_WINDOW_DAYS, BATTERY_EMPTY_LEVEL
+
+
+def fit_discharge(groups, seconds, charges, count):
+    """
+    Least squares line charge = intercept + slope * t for every group at once.
+    :param groups: int array of group indices 0..count-1
+    :param seconds: float array of readout times
+    :param charges: float array of charge values
+    :param count: number of groups
+    :return: (slope, intercept) arrays, NaN for groups with less than two distinct readout times
+    """
+    n = np.bincount(groups, minlength=count).astype(float)
+    sum_t = np.bincount(groups, weights=seconds, minlength=count)
+    sum_y = np.bincount(groups, weights=charges, minlength=count)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_t = sum_t / n
+        mean_y = sum_y / n
+        # Centered sums keep the precision with epoch-sized times
+        dt = seconds - mean_t[groups]
+        dy = charges - mean_y[groups]
+        s_tt = np.bincount(groups, weights=dt * dt, minlength=count)
+        s_ty = np.bincount(groups, weights=dt * dy, minlength=count)
+        slope = s_ty / s_tt
+    slope[s_tt == 0] = np.nan
+    intercept = mean_y - slope * mean_t
+    return slope, intercept
+
+
+def forecast_depletion(now=None, days=BATTERY_FORECAST_WINDOW_DAYS):
+    """
+    Predicts when every located device reaches BATTERY_EMPTY_LEVEL from its recent charge history.
+    :param now: end of the history window (now by default)
+    :param days: length of the history window
+    :return: dict device id -> predicted depletion datetime (None if the battery is not discharging)
+    """
+    from hub.models import Readout, Device
+
+    now = now or datetime.now()
+    start_date = now - timedelta(days=days)
+    capacities = dict(Device.objects.filter(location__isnull=False, battery_capacity__isnull=False)
+                      .values_list('id', 'battery_capacity'))
+    rows = list(Readout.objects.filter(device_id__in=capacities.keys(), timestamp__gte=start_date,
+                                       averagereadout__isnull=True).order_by().values_list('device_id', 'timestamp',
+                                                                                           'charge'))
+    forecast = dict.fromkeys(capacities)
+    if not rows:
+        return forecast
+
+    devices = np.array([row[0] for row in rows])
+    seconds = np.array([(row[1] - start_date).total_seconds() for row in rows])
+    charges = np.array([row[2] for row in rows], dtype=float)
+    device_ids, groups = np.unique(devices, return_inverse=True)
+
+    slope, intercept = fit_discharge(groups, seconds, charges, len(device_ids))
+    thresholds = np.array([capacities[device_id] for device_id in device_ids]) * BATTERY_EMPTY_LEVEL / 100
+    with np.errstate(invalid='ignore', divide='ignore'):
+        empty_at = (thresholds - intercept) / slope
+    # Flat discharge curves would be predicted centuries ahead
+    discharging = (np.nan_to_num(slope) < 0) & (np.nan_to_num(empty_at) < 5 * 365 * 86400)
+    for i in np.flatnonzero(discharging):
+        forecast[int(device_ids[i])] = start_date + timedelta(seconds=max(float(empty_at[i]), 0))
+    return forecast
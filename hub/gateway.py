@@ -0,0 +1,44 @@
+import json
+
+from aiohttp import web
+
+from hub.ingest import BatchWriter
+
+
+class IngestGateway(object):
+    """
+    Asynchronous HTTP endpoint with the POST /api/readouts/ contract of ReadoutViewSet.create.
+    Uploads are validated and stored in batches by a BatchWriter.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    async def readouts(self, request):
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.json_response({"detail": "JSON parse error"}, status=400)
+        if not isinstance(data, (dict, list)) or data == []:
+            return web.json_response({"non_field_errors": ["Invalid data"]}, status=400)
+        status, body, headers = await self.writer.submit(data)
+        return web.json_response(body, status=status, headers=headers,
+                                 dumps=lambda obj: json.dumps(obj, ensure_ascii=False))
+
+
+def make_app(loop, **writer_options):
+    writer = BatchWriter(loop, **writer_options)
+    gateway = IngestGateway(writer)
+    app = web.Application(loop=loop)
+    app.router.add_post('/api/readouts/', gateway.readouts)
+    app.router.add_post('/api/readouts', gateway.readouts)
+
+    async def start_writer(app):
+        app['writer'] = loop.create_task(writer.run())
+
+    async def stop_writer(app):
+        app['writer'].cancel()
+
+    app.on_startup.append(start_writer)
+    app.on_cleanup.append(stop_writer)
+    return app
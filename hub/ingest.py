@@ -0,0 +1,234 @@
+import asyncio
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from django.db import connection, transaction, close_old_connections
+from django.db.models import F
+
+from ClimateBox.settings import INGEST_BATCH_SIZE, INGEST_BATCH_DELAY
+from hub.deadband import deadband_filter
+from hub.metrics import READOUTS_INGESTED, PROCESS_READOUT_DURATION
+from hub.models import Readout, Device, DeviceReception
+
+
+INSERT_SQL = 'INSERT INTO hub_readout (timestamp, device_id, location_id, charge, temp, "CO2", humid) ' \
+             'VALUES {values} ON CONFLICT (device_id, timestamp) DO NOTHING RETURNING id, device_id, timestamp'
+
+INSERT_CHUNK_SIZE = 1000
+
+RECEPTION_SQL = 'INSERT INTO hub_devicereception (device_id, date, received, last_dropped) VALUES {values} ' \
+                'ON CONFLICT (device_id, date) DO UPDATE SET ' \
+                'received = hub_devicereception.received + EXCLUDED.received, ' \
+                'last_dropped = GREATEST(hub_devicereception.last_dropped, EXCLUDED.last_dropped)'
+
+
+def insert_readouts(readouts):
+    """
+    Bulk inserts readouts skipping the ones already stored for the same (device, timestamp).
+    :return: list of inserted readouts
+    """
+    unique = []
+    seen = set()
+    for readout in readouts:
+        key = (readout.device_id, readout.timestamp)
+        if key not in seen:
+            seen.add(key)
+            unique.append(readout)
+
+    if connection.vendor != 'postgresql':
+        stored = set(Readout.objects.filter(device_id__in={readout.device_id for readout in unique},
+                                            timestamp__in={readout.timestamp for readout in unique})
+                     .values_list('device_id', 'timestamp'))
+        inserted = [readout for readout in unique if (readout.device_id, readout.timestamp) not in stored]
+        Readout.objects.bulk_create(inserted)
+        return inserted
+
+    inserted = []
+    for start in range(0, len(unique), INSERT_CHUNK_SIZE):
+        chunk = unique[start:start + INSERT_CHUNK_SIZE]
+        params = []
+        for readout in chunk:
+            params += [readout.timestamp, readout.device_id, readout.location_id, readout.charge, readout.temp,
+                       readout.CO2, readout.humid]
+        with connection.cursor() as cursor:
+            cursor.execute(INSERT_SQL.format(values=", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(chunk))), params)
+            ids = {(device_id, timestamp): pk for pk, device_id, timestamp in cursor.fetchall()}
+        for readout in chunk:
+            pk = ids.get((readout.device_id, readout.timestamp))
+            if pk is not None:
+                readout.id = pk
+                readout._state.adding = False
+                readout._state.db = connection.alias
+                inserted.append(readout)
+    return inserted
+
+
+def count_received(stored, dropped=()):
+    """
+    Adds the received readouts to the daily counters of their devices (DeviceReception)
+    :param stored: newly stored readouts, the insert already skipped the repeated ones
+    :param dropped: readouts the deadband dropped. Nothing is stored for them, so only the ones newer than the
+                    last dropped readout counted for the device that day count: a retried upload counts once.
+    """
+    counts = Counter((readout.device_id, readout.timestamp.date()) for readout in stored)
+    last_dropped = {}
+    dropped = {(readout.device_id, readout.timestamp) for readout in dropped}
+    if dropped:
+        counted = {(device_id, date): last for device_id, date, last in DeviceReception.objects.select_for_update()
+                   .filter(device_id__in={device_id for device_id, _ in dropped},
+                           date__in={timestamp.date() for _, timestamp in dropped})
+                   .values_list('device_id', 'date', 'last_dropped')}
+        for device_id, timestamp in dropped:
+            key = (device_id, timestamp.date())
+            if counted.get(key) is None or timestamp > counted[key]:
+                counts[key] += 1
+                last_dropped[key] = max(last_dropped.get(key, timestamp), timestamp)
+    if not counts:
+        return
+    if connection.vendor != 'postgresql':
+        for key, received in counts.items():
+            reception, _ = DeviceReception.objects.get_or_create(device_id=key[0], date=key[1])
+            updates = {'received': F('received') + received}
+            if key in last_dropped and (reception.last_dropped is None or last_dropped[key] > reception.last_dropped):
+                updates['last_dropped'] = last_dropped[key]
+            DeviceReception.objects.filter(id=reception.id).update(**updates)
+        return
+    params = []
+    for key, received in sorted(counts.items()):
+        params += [key[0], key[1], received, last_dropped.get(key)]
+    with connection.cursor() as cursor:
+        cursor.execute(RECEPTION_SQL.format(values=", ".join(["(%s, %s, %s, %s::timestamp)"] * len(counts))), params)
+
+
+def store_readouts(uploads):
+    """
+    Stores validated uploads with a single bulk insert and updates their devices.
+    Readouts already stored for the same device and timestamp (retries, replays) are skipped, and so are
+    the unchanged readouts of deadband locations (see hub.deadband).
+    :param uploads: list of valid ReadoutCreateSerializer, single or many=True
+    :return: list of (new Readout list, number of skipped duplicates), one per upload. New readouts dropped by
+             the deadband are included but have no id.
+    """
+    now = datetime.now()
+    built = []
+    for serializer in uploads:
+        items = serializer.validated_data if isinstance(serializer.validated_data, list) \
+            else [serializer.validated_data]
+        built.append([Readout(timestamp=item.get('timestamp') or now, device=item['device'],
+                              location=item['device'].location, charge=item['charge'], temp=item.get('temp'),
+                              CO2=item.get('CO2'), humid=item.get('humid')) for item in items])
+
+    with transaction.atomic():
+        kept, dropped = deadband_filter([readout for readouts in built for readout in readouts])
+        new = insert_readouts(kept)
+        count_received(new, dropped)
+        dropped = set(map(id, dropped))
+        inserted = set(map(id, new)) | dropped
+        for readouts in built:
+            device = readouts[-1].device
+            device.last_connection = now
+            device.charge = readouts[-1].charge
+            Device.objects.filter(id=device.id).update(last_connection=now, charge=device.charge)
+
+    stored = []
+    for readouts in built:
+        accepted = [readout for readout in readouts if id(readout) in inserted]
+        stored.append((accepted, len(readouts) - len(accepted)))
+        READOUTS_INGESTED.labels(readouts[-1].location.building).inc(
+            sum(id(readout) not in dropped for readout in accepted))
+    return stored
+
+
+def evaluate_readouts(readouts):
+    """
+    Runs the alert rules for a stored upload
+    :return: sleep time for the device in ms
+    """
+    from hub.tasks import process_readout, default_sleep_time
+    if not readouts:
+        # Nothing new, the upload was a retry
+        return default_sleep_time()
+    with PROCESS_READOUT_DURATION.time():
+        return process_readout(readouts)
+
+
+def upload_headers(readouts, duplicates):
+    return {'X-Readouts-Accepted': str(len(readouts)), 'X-Readouts-Duplicate': str(duplicates)}
+
+
+def process_uploads(uploads):
+    """
+    Validates, stores and evaluates a batch of uploads the way ReadoutViewSet.create does.
+    :param uploads: list of request bodies (a readout or a list of readouts)
+    :return: list of (HTTP status, response data, response headers), one per upload
+    """
+    from hub.serializers import ReadoutCreateSerializer
+
+    close_old_connections()
+    try:
+        results = [None] * len(uploads)
+        valid = []
+        for i, data in enumerate(uploads):
+            serializer = ReadoutCreateSerializer(data=data, many=isinstance(data, list))
+            if serializer.is_valid():
+                valid.append((i, serializer))
+            else:
+                results[i] = (400, serializer.errors, {})
+
+        stored = store_readouts([serializer for i, serializer in valid])
+        for (i, serializer), (readouts, duplicates) in zip(valid, stored):
+            results[i] = (201, str(evaluate_readouts(readouts)), upload_headers(readouts, duplicates))
+        return results
+    finally:
+        close_old_connections()
+
+
+class BatchWriter(object):
+    """
+    Collects uploads from asyncio handlers and processes them in batches in a single worker thread,
+    so slow clients only hold a coroutine and the database sees a few bulk inserts.
+    """
+
+    def __init__(self, loop, batch_size=INGEST_BATCH_SIZE, batch_delay=INGEST_BATCH_DELAY, process=process_uploads):
+        self.loop = loop
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.process = process
+        self.queue = asyncio.Queue(loop=loop)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def submit(self, data):
+        """
+        :return: future of the (status, data, headers) result of process_uploads for :data:
+        """
+        future = self.loop.create_future()
+        self.queue.put_nowait((data, future))
+        return future
+
+    async def next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = self.loop.time() + self.batch_delay
+        while len(batch) < self.batch_size:
+            timeout = deadline - self.loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout, loop=self.loop))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        while True:
+            batch = await self.next_batch()
+            try:
+                results = await self.loop.run_in_executor(self.executor, self.process, [data for data, _ in batch])
+            except Exception as exc:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
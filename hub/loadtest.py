@@ -0,0 +1,179 @@
+"""
+Load test against a running server: virtual devices register with the one-time key flow and upload
+readouts like the firmware does (sleeping the time the server answers), while dashboard clients poll the
+list endpoints. Run with manage.py loadtest.
+"""
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import aiohttp
+import numpy as np
+
+
+class Stats(object):
+    """
+    Latencies and errors per request kind
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.readouts = 0
+        self.duplicates = 0
+
+    def record(self, kind, latency, ok):
+        self.latencies[kind].append(latency)
+        if not ok:
+            self.errors[kind] += 1
+
+    def report(self, elapsed):
+        """
+        :return: dict with the sustained "readouts_per_second" and per request kind the "requests", "errors",
+                 "error_rate" and latency percentiles "p50", "p95", "p99" in ms
+        """
+        kinds = {}
+        for kind, latencies in self.latencies.items():
+            p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+            kinds[kind] = {"requests": len(latencies), "errors": self.errors[kind],
+                           "error_rate": self.errors[kind] / len(latencies), "p50": p50, "p95": p95, "p99": p99}
+        return {"elapsed": elapsed, "readouts": self.readouts, "duplicates": self.duplicates,
+                "readouts_per_second": self.readouts / elapsed if elapsed else 0, "kinds": kinds}
+
+
+async def timed(stats, kind, session, method, url, **kwargs):
+    """
+    Makes a request and records its latency
+    :return: (status, body text, headers), status 0 on connection errors
+    """
+    start = time.perf_counter()
+    try:
+        async with session.request(method, url, **kwargs) as response:
+            body = await response.text()
+            status, headers = response.status, response.headers
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        status, body, headers = 0, "", {}
+    stats.record(kind, time.perf_counter() - start, 200 <= status < 400)
+    return status, body, headers
+
+
+async def login(session, url, username, password):
+    """
+    Logs :session: in through the login form
+    """
+    async with session.get(url + "/accounts/login/") as response:
+        await response.read()
+    csrf = next((cookie.value for cookie in session.cookie_jar if cookie.key == 'csrftoken'), "")
+    async with session.post(url + "/accounts/login/", data={
+        'username': username, 'password': password, 'csrfmiddlewaretoken': csrf, 'next': '/'
+    }, headers={'Referer': url + "/accounts/login/"}) as response:
+        await response.read()
+    if not any(cookie.key == 'sessionid' for cookie in session.cookie_jar):
+        raise RuntimeError("Login as %s failed" % username)
+
+
+async def register(stats, admin, device_session, url, mac):
+    """
+    Registers a virtual device with a fresh one-time key
+    :return: device id
+    """
+    for _ in range(5):
+        status, body, _ = await timed(stats, "secret_key", admin, 'GET', url + "/api/secret_key")
+        if status != 200:
+            raise RuntimeError("Could not get the registration key (HTTP %d), is the user staff?" % status)
+        status, body, _ = await timed(stats, "register", device_session, 'POST', url + "/api/devices/",
+                                      json={'key': json.loads(body)['key'], 'MAC': mac, 'charge': 4.0})
+        if status == 201:
+            return int(json.loads(body).split(",")[0])
+        if status != 403:
+            break
+        # The key was used by someone else meanwhile
+    raise RuntimeError("Could not register device %s (HTTP %d)" % (mac, status))
+
+
+def mac_addresses(count):
+    """
+    Locally administered MAC addresses, random per run so devices of earlier runs are not reused
+    """
+    run = random.getrandbits(16)
+    return ["02:%02X:%02X:%02X:%02X:%02X" % (run >> 8, run & 0xFF, number >> 16 & 0xFF, number >> 8 & 0xFF,
+                                             number & 0xFF) for number in range(count)]
+
+
+def reading(device_id, timestamp=None):
+    data = {'device': device_id, 'charge': round(random.uniform(3.6, 4.1), 3),
+            'temp': round(random.gauss(22, 1), 1), 'CO2': round(random.uniform(400, 900)),
+            'humid': round(random.uniform(30, 50), 1)}
+    if timestamp is not None:
+        data['timestamp'] = timestamp.isoformat()
+    return data
+
+
+async def device_loop(stats, session, url, device_id, deadline, speedup, batch_share, batch_size):
+    """
+    Uploads readouts until :deadline:, sleeping the time the server answers divided by :speedup:.
+    :batch_share: of the uploads carry :batch_size: readouts buffered since the previous upload.
+    """
+    sleep = random.uniform(0, 300 / speedup)
+    while True:
+        await asyncio.sleep(max(min(sleep, deadline - time.perf_counter()), 0))
+        if time.perf_counter() >= deadline:
+            return
+        if random.random() < batch_share:
+            now = datetime.now()
+            data = [reading(device_id, now - timedelta(seconds=i * 60)) for i in reversed(range(batch_size))]
+            kind = "batch"
+        else:
+            data = reading(device_id)
+            kind = "readout"
+        status, body, headers = await timed(stats, kind, session, 'POST', url + "/api/readouts/", json=data)
+        stats.readouts += int(headers.get('X-Readouts-Accepted', 0))
+        stats.duplicates += int(headers.get('X-Readouts-Duplicate', 0))
+        try:
+            sleep = int(json.loads(body)) / 1000 / speedup
+        except (ValueError, TypeError):
+            sleep = 300 / speedup
+
+
+async def dashboard_loop(stats, session, url, location_id, deadline, interval):
+    """
+    Polls the dashboard endpoints every :interval: seconds until :deadline:
+    """
+    endpoints = ["/api/devices/", "/api/alerts/", "/api/readouts/?location=%d" % location_id,
+                 "/api/readouts/?location=%d&period=week" % location_id]
+    await asyncio.sleep(random.uniform(0, interval))
+    while time.perf_counter() < deadline:
+        for endpoint in endpoints:
+            await timed(stats, "dashboard", session, 'GET', url + endpoint)
+        await asyncio.sleep(max(min(interval, deadline - time.perf_counter()), 0))
+
+
+async def run(loop, url, ingest_url, username, password, devices, duration, dashboards, poll_interval, speedup,
+              batch_share, batch_size, setup_location, device_ids):
+    """
+    :param setup_location: callable assigning the registered device ids to a location, returns its id
+    :param device_ids: list the id of every device is appended to as soon as it registers, so the caller
+                       can clean up after a failure too
+    :return: Stats.report
+    """
+    stats = Stats()
+    jar = aiohttp.CookieJar(unsafe=True, loop=loop)
+    connector = aiohttp.TCPConnector(limit=0, loop=loop)
+    async with aiohttp.ClientSession(cookie_jar=jar, loop=loop) as admin, \
+            aiohttp.ClientSession(connector=connector, loop=loop) as device_session:
+        await login(admin, url, username, password)
+        for mac in mac_addresses(devices):
+            device_ids.append(await register(stats, admin, device_session, url, mac))
+        location_id = await loop.run_in_executor(None, setup_location, device_ids)
+
+        start = time.perf_counter()
+        deadline = start + duration
+        clients = [device_loop(stats, device_session, ingest_url, device_id, deadline, speedup, batch_share,
+                               batch_size) for device_id in device_ids]
+        clients += [dashboard_loop(stats, admin, url, location_id, deadline, poll_interval)
+                    for _ in range(dashboards)]
+        await asyncio.gather(*clients, loop=loop)
+        return stats.report(time.perf_counter() - start)
@@ -0,0 +1,132 @@
+"""
+Leases keeping scheduled tasks single-flight across all workers. A lease expires after TASK_LEASE_TTL
+seconds unless its holder renews it, so a crashed run never blocks the task for long.
+"""
+import threading
+from datetime import datetime
+from functools import wraps
+from uuid import uuid4
+
+from django.conf import settings
+from django.db import connection
+
+from hub.state import store
+
+
+class TaskLease(object):
+    def __init__(self, name, token=None, ttl=None):
+        self.name = name
+        self.token = token or uuid4().hex
+        self.ttl = ttl or settings.TASK_LEASE_TTL
+
+    @property
+    def key(self):
+        return "lease:%s" % self.name
+
+    def acquire(self):
+        """
+        :return: whether the lease was free and is held now
+        """
+        return store().add(self.key, self.token, self.ttl)
+
+    def renew(self):
+        """
+        :return: whether the lease is still held
+        """
+        return store().expire_if(self.key, self.token, self.ttl)
+
+    def release(self):
+        store().pop_if(self.key, self.token)
+
+    def heartbeat(self):
+        return Heartbeat(self)
+
+
+class Heartbeat(object):
+    """
+    Renews a lease in a background thread while the enclosed block runs
+    """
+
+    def __init__(self, lease):
+        self.lease = lease
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.lease.ttl / 3):
+                self.lease.renew()
+        finally:
+            connection.close()
+
+    def __enter__(self):
+        self.lease.renew()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+
+def run_started(name):
+    from hub.models import TaskRun
+    TaskRun.objects.update_or_create(name=name, defaults={'status': 'r', 'started': datetime.now(), 'finished': None,
+                                                          'duration': None, 'skipped': 0, 'message': ''})
+
+
+def run_finished(name, failed=False, message='', lease=None):
+    """
+    Records the end of the current run of :name:. Given the run's :lease:, records nothing once the lease is
+    no longer held, i.e. for a late result of a run that expired (and maybe was superseded by another one).
+    :return: whether the run was recorded
+    """
+    from hub.models import TaskRun
+    if lease is not None and not lease.renew():
+        return False
+    run = TaskRun.objects.filter(name=name).first()
+    if run is None:
+        return False
+    run.status = 'f' if failed else 's'
+    run.finished = datetime.now()
+    run.duration = (run.finished - run.started).total_seconds()
+    run.message = message
+    run.save()
+    return True
+
+
+def run_skipped(name):
+    from hub.models import TaskRun, Log
+    from django.db.models import F
+    TaskRun.objects.filter(name=name).update(skipped=F('skipped') + 1)
+    Log.objects.create(type='w', tag=name, message="Skipped, the previous run is still in progress")
+
+
+def single_flight(name):
+    """
+    Runs the decorated task only if no other run of :name: is in progress anywhere, otherwise skips it.
+    Records the runs in TaskRun.
+    """
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            lease = TaskLease(name)
+            if not lease.acquire():
+                run_skipped(name)
+                return None
+            run_started(name)
+            try:
+                with lease.heartbeat():
+                    result = function(*args, **kwargs)
+            except Exception as exc:
+                run_finished(name, failed=True, message=repr(exc))
+                raise
+            finally:
+                lease.release()
+            run_finished(name)
+            return result
+
+        return wrapper
+
+    return decorator
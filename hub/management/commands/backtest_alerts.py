@@ -0,0 +1,52 @@
+import time
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from hub.backtest import backtest
+
+totals = ("alerts", "escalations", "emails", "battery_alerts", "readouts")
+
+
+class Command(BaseCommand):
+    help = 'Replays the alert rules over stored readouts and reports the alerts, escalations and emails they ' \
+           'would have produced, optionally with changed location settings. Nothing is written.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help="YYYY-MM-DD, a year ago by default")
+        parser.add_argument('--end', help="YYYY-MM-DD, now by default")
+        parser.add_argument('--location', type=int, action='append', help="Location id (all by default)")
+        parser.add_argument('--max-temp-deviation', type=float)
+        parser.add_argument('--warm-norm', type=float, help="Warm season normal temperature")
+        parser.add_argument('--cold-norm', type=float, help="Cold season normal temperature")
+        parser.add_argument('--episodes', action='store_true', help="List every would-be temperature alert")
+
+    def handle(self, *args, **options):
+        try:
+            end_date = datetime.strptime(options['end'], "%Y-%m-%d") if options['end'] else datetime.now()
+            start_date = datetime.strptime(options['start'], "%Y-%m-%d") if options['start'] \
+                else end_date - timedelta(days=365)
+        except ValueError:
+            raise CommandError("Dates should be YYYY-MM-DD")
+
+        overrides = {'max_temp_deviation': options['max_temp_deviation'],
+                     'warm_season_normal_temp': options['warm_norm'],
+                     'cold_season_normal_temp': options['cold_norm']}
+        start = time.time()
+        report = backtest(start_date, end_date, options['location'], **overrides)
+        elapsed = time.time() - start
+
+        for location, result in report.items():
+            self.stdout.write("%s: %s" % (location, ", ".join("%s %d" % (key, result[key]) for key in totals)))
+            if options['episodes']:
+                for first, last, readouts, escalations, email in result["episodes"]:
+                    self.stdout.write("    %s - %s: %d readouts, %d escalations%s" % (
+                        datetime.utcfromtimestamp(first), datetime.utcfromtimestamp(last), readouts, escalations,
+                        ", email at %s" % datetime.utcfromtimestamp(email) if email is not None else ""))
+        self.stdout.write("Total: %s (%.2f s)" % (
+            ", ".join("%s %d" % (key, sum(result[key] for result in report.values())) for key in totals), elapsed))
+
+        if any(value is not None for value in overrides.values()):
+            current = backtest(start_date, end_date, options['location'])
+            self.stdout.write("With current settings: %s" % ", ".join(
+                "%s %d" % (key, sum(result[key] for result in current.values())) for key in totals))
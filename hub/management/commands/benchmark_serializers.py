@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from hub.benchmarks import benchmark_serializers
+
+
+class Command(BaseCommand):
+    help = 'Compares the readout list output through serializers with the values_list fast path'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=5000, help="Number of latest readouts to serialize")
+        parser.add_argument('--runs', type=int, default=5, help="Measurements per path, the best is shown")
+
+    def handle(self, *args, **options):
+        result = benchmark_serializers(options['rows'], options['runs'])
+        rows = result['rows']
+        if not rows:
+            raise CommandError("No readouts to serialize")
+        for name in ('serializer', 'fast'):
+            self.stdout.write("%s: %.3f s, %.1f us per row" % (name, result[name], result[name] / rows * 1e6))
+        self.stdout.write("Removed per row overhead: %.1f us (%.1fx faster)" % (
+            (result['serializer'] - result['fast']) / rows * 1e6, result['serializer'] / result['fast']))
+        if not result['identical']:
+            raise CommandError("The outputs differ")
+        self.stdout.write(self.style.SUCCESS("The outputs are identical"))
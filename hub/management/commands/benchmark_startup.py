@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from hub.benchmarks import measure_startup
+
+
+class Command(BaseCommand):
+    help = 'Measures cold start (django.setup() and the first request) of web and worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--process', choices=['web', 'worker'], action='append',
+                            help="Process type to measure (both by default)")
+        parser.add_argument('--runs', type=int, default=3, help="Measurements per process type, the best is shown")
+
+    def handle(self, *args, **options):
+        over_budget = []
+        for process in options['process'] or ['web', 'worker']:
+            timings = min((measure_startup(process) for _ in range(options['runs'])), key=lambda t: t['setup'])
+            budget = settings.STARTUP_TIME_BUDGET[process]
+            self.stdout.write("%s: setup %.3f s (budget %.3f s), first request %.3f s, %d modules" % (
+                process, timings['setup'], budget, timings['first_request'], timings['modules']))
+            if timings['setup'] > budget:
+                over_budget.append(process)
+
+        if over_budget:
+            raise CommandError("Startup time budget exceeded: %s" % ", ".join(over_budget))
+        self.stdout.write(self.style.SUCCESS("Startup time is within budget"))
@@ -0,0 +1,87 @@
+import time
+
+from django.db import connection, transaction
+from django.db.models import Max, Min
+from django.core.management.base import BaseCommand
+
+from hub.models import Readout, Log
+
+# Keeps the first stored raw readout of every (device, timestamp)
+DEDUPLICATE_SQL = """
+DELETE FROM hub_readout r
+USING hub_readout d
+WHERE r.id BETWEEN %s AND %s
+  AND d.device_id = r.device_id AND d.timestamp = r.timestamp AND d.id < r.id
+  AND NOT EXISTS (SELECT 1 FROM hub_averagereadout a WHERE a.readout_ptr_id = r.id)
+  AND NOT EXISTS (SELECT 1 FROM hub_averagereadout a WHERE a.readout_ptr_id = d.id)
+"""
+
+# Keeps the newest daily average of every (device, timestamp), older ones were stored for a previous location
+DEDUPLICATE_AVERAGES_SQL = """
+WITH doomed AS (
+    SELECT r.id FROM hub_readout r
+    JOIN hub_averagereadout a ON a.readout_ptr_id = r.id
+    WHERE r.id BETWEEN %s AND %s AND EXISTS (
+        SELECT 1 FROM hub_readout d
+        JOIN hub_averagereadout da ON da.readout_ptr_id = d.id
+        WHERE d.device_id = r.device_id AND d.timestamp = r.timestamp AND d.id > r.id)
+), averages AS (
+    DELETE FROM hub_averagereadout WHERE readout_ptr_id IN (SELECT id FROM doomed)
+)
+DELETE FROM hub_readout WHERE id IN (SELECT id FROM doomed)
+"""
+
+# Raw readouts taken exactly at midnight share the key of the daily average, they move a second later
+# unless that slot is taken as well
+MOVE_COLLIDING_SQL = """
+UPDATE hub_readout r SET timestamp = r.timestamp + INTERVAL '1 second'
+WHERE r.id BETWEEN %s AND %s
+  AND NOT EXISTS (SELECT 1 FROM hub_averagereadout a WHERE a.readout_ptr_id = r.id)
+  AND EXISTS (SELECT 1 FROM hub_readout d JOIN hub_averagereadout da ON da.readout_ptr_id = d.id
+              WHERE d.device_id = r.device_id AND d.timestamp = r.timestamp)
+  AND NOT EXISTS (SELECT 1 FROM hub_readout d
+                  WHERE d.device_id = r.device_id AND d.timestamp = r.timestamp + INTERVAL '1 second')
+"""
+
+DELETE_COLLIDING_SQL = """
+DELETE FROM hub_readout r
+WHERE r.id BETWEEN %s AND %s
+  AND NOT EXISTS (SELECT 1 FROM hub_averagereadout a WHERE a.readout_ptr_id = r.id)
+  AND EXISTS (SELECT 1 FROM hub_readout d JOIN hub_averagereadout da ON da.readout_ptr_id = d.id
+              WHERE d.device_id = r.device_id AND d.timestamp = r.timestamp)
+"""
+
+
+class Command(BaseCommand):
+    help = 'Removes readouts and daily averages stored more than once for the same device and timestamp and ' \
+           'moves readouts colliding with a daily average, in id-range chunks. ' \
+           'Run it before the migration adding the (device, timestamp) unique constraint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=100000, help="Readout ids per transaction")
+        parser.add_argument('--delay', type=float, default=0.1, help="Pause between chunks (s)")
+
+    def handle(self, *args, **options):
+        bounds = Readout.objects.aggregate(Min('id'), Max('id'))
+        if bounds['id__min'] is None:
+            return
+        removed = averages = moved = 0
+        for first_id in range(bounds['id__min'], bounds['id__max'] + 1, options['chunk_size']):
+            last_id = first_id + options['chunk_size'] - 1
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(DEDUPLICATE_SQL, [first_id, last_id])
+                removed += cursor.rowcount
+                cursor.execute(DEDUPLICATE_AVERAGES_SQL, [first_id, last_id])
+                averages += cursor.rowcount
+                cursor.execute(MOVE_COLLIDING_SQL, [first_id, last_id])
+                moved += cursor.rowcount
+                cursor.execute(DELETE_COLLIDING_SQL, [first_id, last_id])
+                removed += cursor.rowcount
+            self.stdout.write("%d-%d: %d duplicate readouts and %d duplicate averages removed, %d readouts moved "
+                              "so far" % (first_id, last_id, removed, averages, moved))
+            time.sleep(options['delay'])
+
+        message = "Removed %d duplicate readouts and %d duplicate daily averages, moved %d readouts off the " \
+                  "timestamp of a daily average" % (removed, averages, moved)
+        Log.objects.create(type='n', tag="deduplicate_readouts", message=message)
+        self.stdout.write(self.style.SUCCESS(message))
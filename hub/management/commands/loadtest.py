@@ -0,0 +1,74 @@
+import asyncio
+
+from django.core.management.base import BaseCommand, CommandError
+
+from hub.loadtest import run
+from hub.models import Device, Location, Readout
+
+
+class Command(BaseCommand):
+    help = 'Load tests a running server with virtual devices uploading readouts and dashboard clients. ' \
+           'Run it on a host sharing the database with the server, the devices get a test location.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help="Server url")
+        parser.add_argument('--ingest-url', help="Url receiving readouts, e.g. the ingest gateway (--url by default)")
+        parser.add_argument('--username', required=True, help="Staff user for the registration key and dashboards")
+        parser.add_argument('--password', required=True)
+        parser.add_argument('--devices', type=int, default=100)
+        parser.add_argument('--duration', type=float, default=60, help="Seconds of load after registration")
+        parser.add_argument('--dashboards', type=int, default=5, help="Concurrently polling dashboard clients")
+        parser.add_argument('--poll-interval', type=float, default=10, help="Dashboard polling interval (s)")
+        parser.add_argument('--speedup', type=float, default=60,
+                            help="Devices sleep the time the server answers divided by this")
+        parser.add_argument('--batch-share', type=float, default=0.1, help="Share of batched uploads")
+        parser.add_argument('--batch-size', type=int, default=10, help="Readouts per batched upload")
+        parser.add_argument('--location', type=int, help="Location for the devices (a new test location by default)")
+        parser.add_argument('--keep', action='store_true', help="Keep the devices, test location and its readouts")
+        parser.add_argument('--sla-p95', type=float, help="Fail if the p95 latency of uploads exceeds this (ms)")
+        parser.add_argument('--max-error-rate', type=float, default=0.01)
+
+    def handle(self, *args, **options):
+        created = []
+
+        def setup_location(device_ids):
+            if options['location']:
+                location = Location.objects.get(id=options['location'])
+            else:
+                location = Location.objects.create(building='un', floor=0, description="Нагрузочный тест")
+                created.append(location)
+            Device.objects.filter(id__in=device_ids).update(location=location)
+            return location.id
+
+        loop = asyncio.get_event_loop()
+        device_ids = []
+        try:
+            report = loop.run_until_complete(run(
+                loop, options['url'].rstrip('/'), (options['ingest_url'] or options['url']).rstrip('/'),
+                options['username'], options['password'], options['devices'], options['duration'],
+                options['dashboards'], options['poll_interval'], options['speedup'], options['batch_share'],
+                options['batch_size'], setup_location, device_ids))
+        except RuntimeError as exc:
+            raise CommandError(str(exc))
+        finally:
+            if not options['keep']:
+                # The generated readouts go first, deleting the devices would leave them in an existing
+                # --location with the device set to NULL
+                Readout.objects.filter(device_id__in=device_ids).delete()
+                Device.objects.filter(id__in=device_ids).delete()
+                for location in created:
+                    location.delete()
+
+        self.stdout.write("%d devices, %.1f s: %d readouts stored (%.1f/s), %d duplicates" % (
+            options['devices'], report['elapsed'], report['readouts'], report['readouts_per_second'],
+            report['duplicates']))
+        failed = []
+        for kind, result in sorted(report['kinds'].items()):
+            self.stdout.write("%-10s %6d requests, %5.2f%% errors, p50 %.1f ms, p95 %.1f ms, p99 %.1f ms" % (
+                kind, result['requests'], result['error_rate'] * 100, result['p50'], result['p95'], result['p99']))
+            if result['error_rate'] > options['max_error_rate']:
+                failed.append("%s error rate" % kind)
+            if options['sla_p95'] and kind in ('readout', 'batch') and result['p95'] > options['sla_p95']:
+                failed.append("%s p95 latency" % kind)
+        if failed:
+            raise CommandError("SLA broken: %s" % ", ".join(failed))
@@ -0,0 +1,24 @@
+import asyncio
+
+from aiohttp import web
+from django.core.management.base import BaseCommand
+
+from ClimateBox.settings import INGEST_BATCH_SIZE, INGEST_BATCH_DELAY
+from hub.gateway import make_app
+
+
+class Command(BaseCommand):
+    help = 'Runs the asynchronous readout ingest gateway (POST /api/readouts/)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='0.0.0.0')
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--batch-size', type=int, default=INGEST_BATCH_SIZE,
+                            help="Max uploads stored in one bulk insert")
+        parser.add_argument('--batch-delay', type=float, default=INGEST_BATCH_DELAY,
+                            help="Max time (s) an upload waits for its batch to fill")
+
+    def handle(self, *args, **options):
+        loop = asyncio.get_event_loop()
+        app = make_app(loop, batch_size=options['batch_size'], batch_delay=options['batch_delay'])
+        web.run_app(app, host=options['host'], port=options['port'])
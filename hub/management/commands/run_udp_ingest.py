@@ -0,0 +1,34 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from ClimateBox.settings import INGEST_BATCH_SIZE, INGEST_BATCH_DELAY, UDP_INGEST_KEY, UDP_INGEST_PORT, \
+    UDP_INGEST_WINDOW
+from hub.ingest import BatchWriter
+from hub.udp import ReadoutProtocol
+
+
+class Command(BaseCommand):
+    help = 'Runs the UDP readout listener for battery-constrained devices (see hub/udp.py for the format)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='0.0.0.0')
+        parser.add_argument('--port', type=int, default=UDP_INGEST_PORT)
+        parser.add_argument('--batch-size', type=int, default=INGEST_BATCH_SIZE)
+        parser.add_argument('--batch-delay', type=float, default=INGEST_BATCH_DELAY)
+
+    def handle(self, *args, **options):
+        loop = asyncio.get_event_loop()
+        writer = BatchWriter(loop, batch_size=options['batch_size'], batch_delay=options['batch_delay'])
+        transport, _ = loop.run_until_complete(loop.create_datagram_endpoint(
+            lambda: ReadoutProtocol(writer, UDP_INGEST_KEY, UDP_INGEST_WINDOW),
+            local_addr=(options['host'], options['port'])))
+        task = loop.create_task(writer.run())
+        self.stdout.write("Listening for readouts on udp://%s:%d" % (options['host'], options['port']))
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            task.cancel()
+            transport.close()
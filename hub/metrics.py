@@ -0,0 +1,50 @@
+"""
+Prometheus metrics. With several gunicorn or Celery worker processes set the prometheus_multiproc_dir
+environment variable to a directory shared by all of them (and empty it on restart), /metrics then
+aggregates the values of every process.
+"""
+import os
+import time
+
+from celery.signals import task_prerun, task_postrun, task_failure
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, \
+    generate_latest, multiprocess
+
+READOUTS_INGESTED = Counter('climatebox_readouts_ingested_total', 'Readouts stored', ['building'])
+REQUEST_LATENCY = Histogram('climatebox_request_latency_seconds', 'API request latency', ['view', 'action'])
+PROCESS_READOUT_DURATION = Histogram('climatebox_process_readout_seconds', 'Alert evaluation time of new readouts')
+TASK_DURATION = Histogram('climatebox_task_duration_seconds', 'Celery task run time', ['task'],
+                          buckets=(.01, .05, .1, .5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, float('inf')))
+TASK_FAILURES = Counter('climatebox_task_failures_total', 'Failed Celery tasks', ['task'])
+
+_task_started = {}
+
+
+@task_prerun.connect
+def task_started(task_id=None, **kwargs):
+    _task_started[task_id] = time.time()
+
+
+@task_postrun.connect
+def task_finished(task_id=None, task=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None and task is not None:
+        TASK_DURATION.labels(task.name).observe(time.time() - started)
+
+
+@task_failure.connect
+def task_failed(sender=None, **kwargs):
+    if sender is not None:
+        TASK_FAILURES.labels(sender.name).inc()
+
+
+def export():
+    """
+    :return: (metrics in the text exposition format, content type)
+    """
+    if 'prometheus_multiproc_dir' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,79 @@
+import gzip
+import re
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+from hub.profiling import Profiled
+from hub.routers import use_replica
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+PRIMARY_COOKIE = 'read_primary'
+
+
+class ProfilingMiddleware(object):
+    """
+    Profiles requests, see hub.profiling.Profiled
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with Profiled('r', "%s %s" % (request.method, request.path)):
+            return self.get_response(request)
+
+
+class ReplicaRoutingMiddleware(object):
+    """
+    Serves safe requests to REPLICA_READ_PATHS from replicas. After a successful write the client reads
+    from the primary for REPLICA_STICKY_SECONDS, so it sees its own changes.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        read_only = request.method in SAFE_METHODS and request.path.startswith(settings.REPLICA_READ_PATHS)
+        with use_replica(read_only and PRIMARY_COOKIE not in request.COOKIES):
+            response = self.get_response(request)
+        if request.method not in SAFE_METHODS and response.status_code < 400 and settings.REPLICA_DATABASES:
+            response.set_cookie(PRIMARY_COOKIE, '1', max_age=settings.REPLICA_STICKY_SECONDS)
+        return response
+
+
+class CompressionMiddleware(object):
+    """
+    Compresses JSON responses with brotli (if installed and accepted by the client) or gzip
+    """
+    min_length = 200
+    accept_re = re.compile(r'\bbr\b')
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.streaming or response.has_header('Content-Encoding') or len(response.content) < self.min_length \
+                or not response.get('Content-Type', '').startswith('application/json'):
+            return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        accepted = request.META.get('HTTP_ACCEPT_ENCODING', '')
+        if brotli is not None and self.accept_re.search(accepted):
+            content, encoding = brotli.compress(response.content, quality=settings.COMPRESSION_LEVEL['br']), 'br'
+        elif 'gzip' in accepted:
+            content, encoding = gzip.compress(response.content, settings.COMPRESSION_LEVEL['gzip']), 'gzip'
+        else:
+            return response
+        if len(content) >= len(response.content):
+            return response
+        response.content = content
+        response['Content-Length'] = str(len(content))
+        response['Content-Encoding'] = encoding
+        return response
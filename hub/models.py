@@ -6,7 +6,6 @@ from macaddress.fields import MACAddressField
 from django.contrib.auth.models import User
 
 from ClimateBox.settings import DEVICE_DEFAULT_SLEEP_TIME
-from hub.tasks import async_send_mail
 
 
 class Location(models.Model):
@@ -37,6 +36,18 @@ class Location(models.Model):
                                            help_text="Максимально возможное отклонение от нормальной температуры "
                                                      "(2°C по умолчанию)",
                                            default=2)
+    deadband = models.BooleanField(verbose_name='Хранить только изменения',
+                                   help_text="Сохранять показание, только если оно отличается от последнего "
+                                             "сохраненного больше порогов ниже или прошел интервал контроля",
+                                   default=False)
+    deadband_temp = models.FloatField(verbose_name='Порог температуры', help_text="°C (0.2 по умолчанию)",
+                                      default=0.2)
+    deadband_humid = models.FloatField(verbose_name='Порог влажности', help_text="% (1 по умолчанию)", default=1)
+    deadband_CO2 = models.FloatField(verbose_name='Порог CO2', help_text="ppm (50 по умолчанию)", default=50)
+    deadband_heartbeat = models.IntegerField(verbose_name='Интервал контроля',
+                                             help_text="Показание сохраняется не реже, чем раз в столько секунд "
+                                                       "(3600 по умолчанию)",
+                                             default=3600)
 
     def __str__(self):
         descr = dict(self.buildings_list)[self.building] + " " + str(self.floor)
@@ -79,6 +90,8 @@ class Device(models.Model):
                                           help_text="Принимать все запросы с этого устройства, игнорируя проверку "
                                                     "времени (ТОЛЬКО ДЛЯ ОБСЛУЖИВАНИЯ)",
                                           default=False)
+    depletion_date = models.DateTimeField(verbose_name='Прогноз разряда',
+                                          help_text="Когда батарея разрядится по прогнозу", null=True, blank=True)
     #last_readout = models.ForeignKey('Readout', related_name='readout', null=True, blank=True, on_delete=models.SET_NULL)
     warning = models.IntegerField(default=0)
 
@@ -105,7 +118,7 @@ class Device(models.Model):
 
 
 class Readout(models.Model):
-    timestamp = models.DateTimeField()
+    timestamp = models.DateTimeField(db_index=True)
     device = models.ForeignKey('Device', on_delete=models.SET_NULL, null=True)
     location = models.ForeignKey('Location', on_delete=models.CASCADE)
     charge = models.FloatField()
@@ -122,6 +135,8 @@ class Readout(models.Model):
 
     class Meta:
         ordering = ('-timestamp',)
+        index_together = (('location', 'timestamp'),)
+        unique_together = (('device', 'timestamp'),)
 
 
 class AverageReadout(Readout):
@@ -130,6 +145,80 @@ class AverageReadout(Readout):
         ordering = ('-timestamp',)
 
 
+class DeviceUptime(models.Model):
+    device = models.ForeignKey('Device', verbose_name='Устройство', on_delete=models.CASCADE)
+    date = models.DateField(verbose_name='Дата')
+    expected = models.IntegerField(verbose_name='Ожидалось показаний')
+    received = models.IntegerField(verbose_name='Получено показаний')
+    gaps = models.IntegerField(verbose_name='Пропуски', help_text="Количество перерывов в передаче данных")
+    longest_gap = models.FloatField(verbose_name='Макс. перерыв', help_text="Самый длинный перерыв в секундах")
+    downtime = models.FloatField(verbose_name='Простой', help_text="Суммарное время без связи в секундах")
+
+    def __str__(self):
+        return "%s %s: %1.1f%%" % (self.date.strftime("%d.%m.%Y"), self.device_id, self.uptime())
+
+    def uptime(self):
+        if not self.expected:
+            return 100.0
+        return min(self.received / self.expected, 1) * 100
+
+    class Meta:
+        ordering = ('-date',)
+        unique_together = (('device', 'date'),)
+        verbose_name = 'доступность устройства'
+        verbose_name_plural = 'доступность устройств'
+
+
+class DeviceReception(models.Model):
+    """
+    Readouts received from a device per day, counted on ingest. Unlike the stored readouts it includes
+    the ones deadband locations drop.
+    """
+    device = models.ForeignKey('Device', verbose_name='Устройство', on_delete=models.CASCADE)
+    date = models.DateField(verbose_name='Дата')
+    received = models.IntegerField(verbose_name='Получено показаний', default=0)
+    # Newest counted readout the deadband dropped, older dropped ones are retries and are not counted again
+    last_dropped = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = (('device', 'date'),)
+        verbose_name = 'приём показаний'
+        verbose_name_plural = 'приём показаний'
+
+
+class AreaAggregate(models.Model):
+    """
+    Hourly aggregate of the readouts of a building floor, or of the whole building when floor is None.
+    Maintained by the rollup_areas task.
+    """
+    building = models.CharField(verbose_name="Здание", max_length=2, choices=Location.buildings_list)
+    floor = models.IntegerField(verbose_name='Этаж', null=True, blank=True)
+    timestamp = models.DateTimeField(verbose_name='Час')
+    locations = models.IntegerField(verbose_name='Расположений', help_text="Расположений с показаниями")
+    readouts = models.IntegerField(verbose_name='Показаний')
+    temp_mean = models.FloatField(null=True)
+    temp_min = models.FloatField(null=True)
+    temp_max = models.FloatField(null=True)
+    humid_mean = models.FloatField(null=True)
+    humid_min = models.FloatField(null=True)
+    humid_max = models.FloatField(null=True)
+    CO2_mean = models.FloatField(null=True)
+    CO2_min = models.FloatField(null=True)
+    CO2_max = models.FloatField(null=True)
+    alerting_locations = models.IntegerField(verbose_name='Расположений с тревогой',
+                                             help_text="Расположений, где температура выходила за пределы нормы")
+
+    def __str__(self):
+        return "%s %s %s" % (self.get_building_display(), "" if self.floor is None else self.floor,
+                             self.timestamp.strftime("%d.%m.%Y %H:%M"))
+
+    class Meta:
+        ordering = ('-timestamp',)
+        index_together = (('building', 'floor', 'timestamp'),)
+        verbose_name = 'сводка по зданию'
+        verbose_name_plural = 'сводки по зданиям'
+
+
 class Alert(models.Model):
     timestamp = models.DateTimeField(null=True)
     location = models.ForeignKey('Location', on_delete=models.CASCADE, null=True, blank=True)
@@ -141,6 +230,7 @@ class Alert(models.Model):
         ('h', 'Humidity level alert'),
         ('b', 'Battery level alert'),
         ('o', 'Out of sync alert'),
+        ('a', 'Anomaly alert'),
         ('s', 'Service alert')
     )
     critical = models.BooleanField(default=False)
@@ -157,12 +247,13 @@ class Alert(models.Model):
         ordering = ('-timestamp',)
 
     def send_alert(self, sender):
+        from hub.tasks import async_send_mail
         if not self.email_sent:
             async_send_mail.delay("ClimateBox", self.message, self.id, sender.id)
 
 
 class Log(models.Model):
-    timestamp = models.DateTimeField(auto_now=True)
+    timestamp = models.DateTimeField(auto_now=True, db_index=True)
     type_list = (
         ('n', 'Notification'),
         ('w', 'Warning'),
@@ -175,3 +266,148 @@ class Log(models.Model):
     def __str__(self):
         return "%s %s [%s] %s" % (
         self.type.upper(), self.timestamp.strftime("%d.%m.%Y %H:%M:%S"), self.tag, self.message)
+
+
+class Profile(models.Model):
+    timestamp = models.DateTimeField(auto_now_add=True)
+    kind_list = (
+        ('r', 'Request'),
+        ('t', 'Task')
+    )
+    kind = models.CharField(max_length=1, choices=kind_list)
+    name = models.CharField(max_length=200)
+    duration = models.FloatField(help_text="Время выполнения в секундах")
+    samples = models.IntegerField()
+    sampled = models.BooleanField(help_text="Выбран случайно (иначе - медленный запрос)")
+    call_tree = models.TextField()
+    stacks = models.TextField(help_text="Стеки вызовов в формате flamegraph")
+
+    def __str__(self):
+        return "%s %s %s (%1.3f с)" % (
+            self.kind.upper(), self.timestamp.strftime("%d.%m.%Y %H:%M:%S"), self.name, self.duration)
+
+    class Meta:
+        ordering = ('-timestamp',)
+        verbose_name = 'профиль'
+        verbose_name_plural = 'профили'
+
+
+class RuntimeValue(models.Model):
+    """
+    Runtime state shared by all processes when Redis is not configured, see hub.state
+    """
+    key = models.CharField(max_length=100, unique=True)
+    value = models.TextField()
+    expires_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.key
+
+
+class TaskRun(models.Model):
+    """
+    Last run of a scheduled task, see hub.locks
+    """
+    name = models.CharField(max_length=100, unique=True)
+    status_list = (
+        ('r', 'Running'),
+        ('s', 'Succeeded'),
+        ('f', 'Failed')
+    )
+    status = models.CharField(max_length=1, choices=status_list)
+    started = models.DateTimeField()
+    finished = models.DateTimeField(null=True, blank=True)
+    duration = models.FloatField(null=True, blank=True, help_text="Время выполнения в секундах")
+    skipped = models.IntegerField(default=0, help_text="Запусков пропущено, пока задача выполнялась")
+    message = models.TextField(blank=True)
+
+    def __str__(self):
+        return "%s: %s" % (self.name, self.get_status_display())
+
+    class Meta:
+        ordering = ('name',)
+        verbose_name = 'запуск задачи'
+        verbose_name_plural = 'запуски задач'
+
+
+class DecommissionJob(models.Model):
+    """
+    Removes the readouts, daily averages and alerts of a location in small batches, see tasks.run_decommission.
+    Progress is saved with every batch, an interrupted job continues where it stopped.
+    """
+    location = models.ForeignKey('Location', verbose_name='Расположение', on_delete=models.SET_NULL, null=True)
+    location_name = models.CharField(verbose_name='Расположение', max_length=200, blank=True)
+    mode_list = (
+        ('a', 'Archive'),
+        ('d', 'Delete')
+    )
+    mode = models.CharField(verbose_name='Режим', max_length=1, choices=mode_list, default='a')
+    status_list = (
+        ('q', 'Queued'),
+        ('r', 'Running'),
+        ('p', 'Paused'),
+        ('d', 'Done'),
+        ('f', 'Failed')
+    )
+    status = models.CharField(verbose_name='Состояние', max_length=1, choices=status_list, default='q')
+    created = models.DateTimeField(verbose_name='Создано', auto_now_add=True,
+                                   help_text="Показания после этого момента не удаляются")
+    updated = models.DateTimeField(verbose_name='Обновлено', auto_now=True)
+    batch_size = models.IntegerField(verbose_name='Размер пакета', default=5000)
+    batch_delay = models.FloatField(verbose_name='Пауза между пакетами', help_text="В секундах", default=0.5)
+    total = models.IntegerField(verbose_name='Всего показаний', null=True, blank=True)
+    readouts = models.IntegerField(verbose_name='Показаний обработано', default=0)
+    averages = models.IntegerField(verbose_name='Средних обработано', default=0)
+    alerts = models.IntegerField(verbose_name='Уведомлений обработано', default=0)
+    last_timestamp = models.DateTimeField(null=True, blank=True)
+    last_id = models.IntegerField(null=True, blank=True)
+    message = models.TextField(blank=True)
+
+    def __str__(self):
+        return "%s (%s): %s" % (self.location_name, self.get_mode_display(), self.get_status_display())
+
+    def progress(self):
+        if not self.total:
+            return 100.0 if self.status == 'd' else 0.0
+        return min((self.readouts + self.averages) / self.total, 1) * 100
+
+    def save(self, *args, **kwargs):
+        if self.location is not None and not self.location_name:
+            self.location_name = str(self.location)[:200]
+        super().save(*args, **kwargs)
+
+    class Meta:
+        ordering = ('-created',)
+        verbose_name = 'вывод из эксплуатации'
+        verbose_name_plural = 'выводы из эксплуатации'
+
+
+class ArchivedReadout(models.Model):
+    """
+    Readout or daily average (average is True) moved out of hub_readout by a DecommissionJob
+    """
+    original_id = models.IntegerField()
+    timestamp = models.DateTimeField()
+    device_id = models.IntegerField(null=True)
+    location_id = models.IntegerField(db_index=True)
+    charge = models.FloatField()
+    temp = models.FloatField(null=True)
+    CO2 = models.FloatField(null=True)
+    humid = models.FloatField(null=True)
+    average = models.BooleanField(default=False)
+    job = models.ForeignKey('DecommissionJob', on_delete=models.SET_NULL, null=True)
+
+
+class ArchivedAlert(models.Model):
+    """
+    Alert moved out of hub_alert by a DecommissionJob
+    """
+    original_id = models.IntegerField()
+    timestamp = models.DateTimeField(null=True)
+    location_id = models.IntegerField(db_index=True)
+    type = models.CharField(max_length=1, choices=Alert.type_list)
+    critical = models.BooleanField(default=False)
+    message = models.TextField(null=True)
+    counter = models.IntegerField()
+    email_sent = models.BooleanField(default=False)
+    job = models.ForeignKey('DecommissionJob', on_delete=models.SET_NULL, null=True)
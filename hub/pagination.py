@@ -0,0 +1,118 @@
+import base64
+from collections import OrderedDict
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class TimestampCursorPagination(BasePagination):
+    """
+    Keyset pagination over (timestamp, id), newest first. The cursor holds the key of the last row of the
+    previous page, so every page is a single index range scan regardless of its depth, and rows added
+    meanwhile do not shift the following pages.
+    Without page_size or cursor GET params the whole list is returned (page_size = None).
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    ordering = ('-timestamp', '-id')
+    page_size = None
+    default_page_size = 100
+    max_page_size = 1000
+    invalid_cursor_message = 'Invalid cursor'
+
+    def get_page_size(self, request):
+        if self.page_size_query_param in request.query_params:
+            try:
+                page_size = int(request.query_params[self.page_size_query_param])
+            except ValueError:
+                page_size = 0
+            if page_size > 0:
+                return min(page_size, self.max_page_size)
+        if self.page_size or self.cursor_query_param in request.query_params:
+            return self.page_size or self.default_page_size
+        return None
+
+    def encode_cursor(self, row):
+        if isinstance(row, dict):
+            timestamp, pk = row['timestamp'], row['id']
+        else:
+            timestamp, pk = row.timestamp, row.pk
+        cursor = "%s|%d" % (timestamp.isoformat(), pk)
+        return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            timestamp, pk = base64.urlsafe_b64decode(encoded.encode()).decode().split('|')
+            timestamp = parse_datetime(timestamp)
+            pk = int(pk)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if timestamp is None:
+            raise NotFound(self.invalid_cursor_message)
+        return timestamp, pk
+
+    def after(self, cursor):
+        """
+        :return: filter for the rows following :cursor:
+        """
+        timestamp, pk = cursor
+        return Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+        self.request = request
+        cursor = self.decode_cursor(request)
+        queryset = queryset.order_by(*self.ordering)
+        if cursor is not None:
+            queryset = queryset.filter(self.after(cursor))
+        rows = list(queryset[:page_size + 1])
+        page = rows[:page_size]
+        self.next_cursor = self.encode_cursor(page[-1]) if len(rows) > page_size else None
+        return page
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data)
+        ]))
+
+
+class IdCursorPagination(TimestampCursorPagination):
+    """
+    Keyset pagination over id, newest first, for lists whose timestamp can be NULL
+    """
+    ordering = ('-id',)
+
+    def encode_cursor(self, row):
+        pk = row['id'] if isinstance(row, dict) else row.pk
+        return base64.urlsafe_b64encode(str(pk).encode()).decode()
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            return int(base64.urlsafe_b64decode(encoded.encode()).decode())
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def after(self, cursor):
+        return Q(id__lt=cursor)
+
+
+class LogCursorPagination(TimestampCursorPagination):
+    page_size = 100
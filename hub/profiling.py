@@ -0,0 +1,126 @@
+import os
+import random
+import signal
+import threading
+import time
+from collections import Counter
+
+from celery.signals import task_prerun, task_postrun
+from django.conf import settings
+
+
+class StackSampler(object):
+    """
+    Samples the call stack of the main thread every :interval: seconds of wall-clock time (SIGALRM).
+    Does nothing outside the main thread, signals can not be handled there.
+    """
+
+    def __init__(self, interval=None):
+        self.interval = interval or settings.PROFILING_INTERVAL
+        self.stacks = Counter()
+        self.active = False
+        self._previous_handler = None
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        if threading.current_thread() is not threading.main_thread():
+            return
+        self._previous_handler = signal.signal(signal.SIGALRM, self._sample)
+        signal.setitimer(signal.ITIMER_REAL, self.interval, self.interval)
+        self.active = True
+
+    def stop(self):
+        if not self.active:
+            return
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, self._previous_handler)
+        self.active = False
+
+    @property
+    def samples(self):
+        return sum(self.stacks.values())
+
+    def collapsed(self):
+        """
+        Stacks in the collapsed format ("caller;callee count" per line) understood by flamegraph tools
+        """
+        return "\n".join("%s %d" % item for item in self.stacks.most_common())
+
+    def call_tree(self, min_share=0.02):
+        """
+        Text call tree with inclusive sample counts, branches below :min_share: of all samples are omitted
+        """
+        tree = {}
+        for stack, count in self.stacks.items():
+            node = tree
+            for function in stack.split(";"):
+                entry = node.setdefault(function, [0, {}])
+                entry[0] += count
+                node = entry[1]
+
+        total = self.samples
+        lines = ["Samples: %d, interval: %1.1f ms" % (total, self.interval * 1000)]
+
+        def walk(node, depth):
+            for function, (count, children) in sorted(node.items(), key=lambda item: -item[1][0]):
+                if count < total * min_share:
+                    continue
+                lines.append("%s%5.1f%% %s" % ("  " * depth, count * 100 / total, function))
+                walk(children, depth + 1)
+
+        walk(tree, 0)
+        return "\n".join(lines)
+
+
+class Profiled(object):
+    """
+    Profiles the enclosed block if profiling is enabled. The profile is stored when the run is randomly
+    sampled (PROFILING_SAMPLE_RATE) or slower than PROFILING_SLOW_THRESHOLD seconds.
+    """
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.sampler = None
+
+    def __enter__(self):
+        if settings.PROFILING_ENABLED:
+            self.sampled = random.random() < settings.PROFILING_SAMPLE_RATE
+            self.sampler = StackSampler()
+            self.sampler.start()
+            self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.sampler is None:
+            return
+        self.sampler.stop()
+        duration = time.time() - self.start
+        if (self.sampled or duration >= settings.PROFILING_SLOW_THRESHOLD) and self.sampler.samples:
+            from hub.models import Profile
+            Profile.objects.create(kind=self.kind, name=self.name[:200], duration=duration,
+                                   samples=self.sampler.samples, sampled=self.sampled,
+                                   call_tree=self.sampler.call_tree(), stacks=self.sampler.collapsed())
+
+
+_task_profiles = {}
+
+
+@task_prerun.connect
+def task_started(task_id=None, task=None, **kwargs):
+    if settings.PROFILING_ENABLED and task is not None:
+        _task_profiles[task_id] = Profiled('t', task.name).__enter__()
+
+
+@task_postrun.connect
+def task_finished(task_id=None, **kwargs):
+    profiled = _task_profiles.pop(task_id, None)
+    if profiled is not None:
+        profiled.__exit__(None, None, None)
@@ -0,0 +1,87 @@
+import json
+from collections import OrderedDict
+
+from django.http import HttpResponse
+from rest_framework.compat import SHORT_SEPARATORS, LONG_SEPARATORS
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+
+class ColumnarRenderer(JSONRenderer):
+    """
+    Selected with ?format=columnar. The views then return time series as parallel arrays (see columns),
+    rendered as compact JSON.
+    """
+    format = 'columnar'
+
+
+def is_columnar(request):
+    renderer = getattr(request, 'accepted_renderer', None)
+    return renderer is not None and renderer.format == ColumnarRenderer.format
+
+
+def columns(rows, fields, delta=False):
+    """
+    Turns rows into parallel arrays: {"timestamp": [epoch seconds], field: [values], ...}
+    :param rows: values dicts or values_list tuples of :fields:, one of them 'timestamp'
+    :param delta: store every timestamp but the first as the difference to the previous one
+    """
+    data = {field: [] for field in fields}
+    for row in rows:
+        if isinstance(row, dict):
+            row = [row[field] for field in fields]
+        for field, value in zip(fields, row):
+            data[field].append(value)
+    timestamps = [int(timestamp.timestamp()) for timestamp in data['timestamp']]
+    if delta:
+        timestamps[1:] = [current - previous for previous, current in zip(timestamps, timestamps[1:])]
+        data['delta'] = True
+    data['timestamp'] = timestamps
+    return data
+
+
+def iso_datetime(value):
+    """
+    Formats a datetime like rest_framework.fields.DateTimeField does with the default ISO 8601 format
+    """
+    if not value:
+        return None
+    value = value.isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def representation(rows, fields):
+    """
+    The data a ModelSerializer with :fields: gives for the same rows, built from values_list tuples (or values
+    dicts) without model instances and serializer fields. The fields must be Float- or IntegerFields and
+    a 'timestamp'.
+    """
+    index = fields.index('timestamp')
+    data = []
+    for row in rows:
+        row = [row[field] for field in fields] if isinstance(row, dict) else list(row)
+        row[index] = iso_datetime(row[index])
+        data.append(OrderedDict(zip(fields, row)))
+    return data
+
+
+def render_json(data):
+    """
+    Encodes :data: to the same bytes JSONRenderer produces with the REST_FRAMEWORK settings, using the
+    C accelerated encoder of the json module
+    """
+    return json.dumps(data, ensure_ascii=not api_settings.UNICODE_JSON, allow_nan=not api_settings.STRICT_JSON,
+                      separators=SHORT_SEPARATORS if api_settings.COMPACT_JSON else LONG_SEPARATORS).encode('utf-8')
+
+
+def list_response(request, rows, fields):
+    """
+    Response with the representation of :rows:, encoded directly unless a non-JSON renderer was requested
+    """
+    data = representation(rows, fields)
+    if type(request.accepted_renderer) is JSONRenderer and 'indent' not in request.accepted_media_type:
+        return HttpResponse(render_json(data), content_type=JSONRenderer.media_type)
+    return Response(data)
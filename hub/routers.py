@@ -0,0 +1,86 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections, DatabaseError
+
+# Replication lag in seconds, 0 when the replica has replayed everything it received
+# (and on servers that are not replicas at all)
+LAG_SQL = "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 " \
+          "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+
+_state = threading.local()
+_lag = {}
+
+
+@contextmanager
+def use_replica(enabled=True):
+    """
+    Routes reads of the enclosed block to a replica (see ReplicaRouter)
+    """
+    previous = getattr(_state, 'replica', False)
+    _state.replica = enabled
+    try:
+        yield
+    finally:
+        _state.replica = previous
+
+
+def replica_lag(alias):
+    """
+    Replication lag of :alias: in seconds, cached for REPLICA_LAG_CHECK_INTERVAL. Infinite if it is unreachable.
+    """
+    now = time.time()
+    checked = _lag.get(alias)
+    if checked is not None and now - checked[0] < settings.REPLICA_LAG_CHECK_INTERVAL:
+        return checked[1]
+    connection = connections[alias]
+    lag = 0.0
+    try:
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(LAG_SQL)
+                lag = float(cursor.fetchone()[0] or 0)
+    except DatabaseError:
+        lag = float('inf')
+    _lag[alias] = (now, lag)
+    return lag
+
+
+def healthy_replica():
+    """
+    :return: a random replica lagging at most REPLICA_MAX_LAG seconds, None if there is none
+    """
+    replicas = [alias for alias in settings.REPLICA_DATABASES
+                if alias in settings.DATABASES and replica_lag(alias) <= settings.REPLICA_MAX_LAG]
+    return random.choice(replicas) if replicas else None
+
+
+def read_database():
+    """
+    Database alias for raw read-only SQL, routed like ORM reads
+    """
+    return ReplicaRouter().db_for_read(None) or 'default'
+
+
+class ReplicaRouter(object):
+    """
+    Sends reads inside use_replica() to a healthy replica, everything else (and all writes) to default.
+    Falls back to default when replicas lag or are down.
+    """
+
+    def db_for_read(self, model, **hints):
+        if getattr(_state, 'replica', False):
+            return healthy_replica()
+        return None
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
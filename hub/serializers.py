@@ -4,7 +4,7 @@ from django.contrib.auth.models import User, Group
 from rest_framework import serializers
 
 from ClimateBox.settings import HUB_SECRET_KEY_LENGTH
-from hub.models import Readout, Device, Alert
+from hub.models import Readout, Device, Alert, DeviceUptime, Log
 
 
 class UserSerializer(serializers.HyperlinkedModelSerializer):
@@ -72,7 +72,7 @@ class DeviceListSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Device
-        fields = ('id', 'location', 'location_id', 'battery_level', 'alert')
+        fields = ('id', 'location', 'location_id', 'battery_level', 'depletion_date', 'alert')
 
 
 class AlertListSerializer(serializers.ModelSerializer):
@@ -96,3 +96,15 @@ class BatteryReadoutListSerializer(serializers.ModelSerializer):
     class Meta:
         model = Readout
         fields = ('timestamp', 'charge')
+
+
+class DeviceUptimeListSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DeviceUptime
+        fields = ('date', 'expected', 'received', 'uptime', 'gaps', 'longest_gap', 'downtime')
+
+
+class LogListSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Log
+        fields = ('id', 'timestamp', 'type', 'tag', 'message')
@@ -0,0 +1,146 @@
+"""
+Mutable runtime state shared by all web and worker processes. Uses Redis when RUNTIME_STATE_REDIS_URL
+is set and the RuntimeValue table otherwise. Every operation is a single atomic round trip.
+"""
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from django.db.models import Q
+from django.utils.crypto import get_random_string
+
+REGISTRATION_KEY = 'registration_key'
+
+# Deletes KEYS[1] if it holds ARGV[1]
+COMPARE_AND_DELETE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Sets the expiry of KEYS[1] to ARGV[2] seconds if it holds ARGV[1]
+COMPARE_AND_EXPIRE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class RedisStore(object):
+    def __init__(self, url):
+        import redis
+        self.redis = redis.StrictRedis.from_url(url, decode_responses=True)
+        self.compare_and_delete = self.redis.register_script(COMPARE_AND_DELETE)
+        self.compare_and_expire = self.redis.register_script(COMPARE_AND_EXPIRE)
+
+    def get(self, key):
+        return self.redis.get(self.name(key))
+
+    def set(self, key, value, ttl=None):
+        self.redis.set(self.name(key), value, ex=ttl)
+
+    def add(self, key, value, ttl=None):
+        """
+        Sets :key: unless it is set already
+        :return: whether the value was set
+        """
+        return bool(self.redis.set(self.name(key), value, ex=ttl, nx=True))
+
+    def pop_if(self, key, value):
+        """
+        Deletes :key: if it holds :value:
+        :return: whether it was deleted
+        """
+        return bool(self.compare_and_delete(keys=[self.name(key)], args=[value]))
+
+    def expire_if(self, key, value, ttl):
+        """
+        Expires :key: in :ttl: seconds from now if it holds :value:
+        :return: whether the expiry was updated
+        """
+        return bool(self.compare_and_expire(keys=[self.name(key)], args=[value, ttl]))
+
+    def delete(self, key):
+        self.redis.delete(self.name(key))
+
+    @staticmethod
+    def name(key):
+        return "%s:%s" % (settings.RUNTIME_STATE_PREFIX, key)
+
+
+class DatabaseStore(object):
+    """
+    Every query goes to the primary, a replica could hand out a key that was used meanwhile
+    """
+
+    @staticmethod
+    def values():
+        from hub.models import RuntimeValue
+        return RuntimeValue.objects.using(DEFAULT_DB_ALIAS)
+
+    def live(self, key):
+        return self.values().filter(Q(expires_at__isnull=True) | Q(expires_at__gt=datetime.now()), key=key)
+
+    @staticmethod
+    def expiry(ttl):
+        return datetime.now() + timedelta(seconds=ttl) if ttl else None
+
+    def get(self, key):
+        return self.live(key).values_list('value', flat=True).first()
+
+    def set(self, key, value, ttl=None):
+        self.values().update_or_create(key=key, defaults={'value': value, 'expires_at': self.expiry(ttl)})
+
+    def add(self, key, value, ttl=None):
+        self.values().filter(key=key, expires_at__lte=datetime.now()).delete()
+        try:
+            with transaction.atomic(using=DEFAULT_DB_ALIAS):
+                self.values().create(key=key, value=value, expires_at=self.expiry(ttl))
+        except IntegrityError:
+            return False
+        return True
+
+    def pop_if(self, key, value):
+        return self.live(key).filter(value=value).delete()[0] > 0
+
+    def expire_if(self, key, value, ttl):
+        return self.live(key).filter(value=value).update(expires_at=self.expiry(ttl)) > 0
+
+    def delete(self, key):
+        self.values().filter(key=key).delete()
+
+
+_store = None
+
+
+def store():
+    global _store
+    if _store is None:
+        url = settings.RUNTIME_STATE_REDIS_URL
+        _store = RedisStore(url) if url else DatabaseStore()
+    return _store
+
+
+def registration_key(attempts=5):
+    """
+    :return: the current device registration key, a new one if the previous was used
+    """
+    for _ in range(attempts):
+        key = get_random_string(length=settings.HUB_SECRET_KEY_LENGTH).upper()
+        if store().add(REGISTRATION_KEY, key):
+            return key
+        # Set by another process meanwhile, unless it was used right after the check
+        current = store().get(REGISTRATION_KEY)
+        if current:
+            return current
+    raise RuntimeError("No registration key after %d attempts" % attempts)
+
+
+def consume_registration_key(key):
+    """
+    Uses up the registration key, so every key registers one device
+    :return: whether :key: was the current registration key
+    """
+    return bool(key) and store().pop_if(REGISTRATION_KEY, str(key).upper())
@@ -1,26 +1,23 @@
-import logging
-import os
+import time
 from datetime import datetime, timedelta
 
-from celery import Celery
-from celery.schedules import crontab
-from celery.task import task, periodic_task
-from celery.utils.log import get_task_logger
-from django.core.mail import send_mail
-from django.template.loader import render_to_string
+from celery import chord
+from celery.task import task
 
-from ClimateBox.settings import DEVICE_DEFAULT_SLEEP_TIME, BOX_EMAIL, SERVICE_EMAIL, DEVICE_NIGHT_SLEEP_TIME
+from ClimateBox.settings import DEVICE_DEFAULT_SLEEP_TIME, BOX_EMAIL, SERVICE_EMAIL, DEVICE_NIGHT_SLEEP_TIME, \
+    UPTIME_GAP_FACTOR, BATTERY_FORECAST_ALERT_DAYS, BATTERY_EMPTY_LEVEL, PERIODIC_TASK_SHARD_SIZE, \
+    AREA_ROLLUP_BACKFILL_DAYS
 # from hub.models import Readout, Alert, Device
 
-from django.conf import settings
-from django.core.mail import EmailMultiAlternatives
 from ClimateBox.celery import app, logger
+from hub.locks import TaskLease, single_flight, run_started, run_finished, run_skipped
 
 
 # logger = get_task_logger(__name__)
 
 
-@periodic_task(run_every=(crontab(minute='*/720')), name="remove_old_alerts", ignore_result=True)
+@task(name="remove_old_alerts", ignore_result=True)
+@single_flight("remove_old_alerts")
 def remove_old_alerts(period=24):
     """
     Removes alerts created earlier that in the last :period: hours.
@@ -34,56 +31,170 @@ def remove_old_alerts(period=24):
     alerts.delete()
 
 
-@periodic_task(run_every=(crontab(hour=23, minute=58)), name="calculate_averages", ignore_result=True)
+def device_shards(size=PERIODIC_TASK_SHARD_SIZE):
+    """
+    Splits located devices into location id ranges. All devices of a location are in the same shard, so
+    the per-location alerts of check_devices are never written by two shards at once.
+    :param size: devices per shard, exceeded when a location has more
+    :return: list of (first location id, last location id)
+    """
+    from hub.models import Device
+    from django.db.models import Count
+    shards = []
+    first_id = None
+    devices = 0
+    for location_id, count in Device.objects.filter(location__isnull=False).values_list('location_id') \
+            .annotate(Count('id')).order_by('location_id'):
+        if first_id is None:
+            first_id = location_id
+        devices += count
+        if devices >= size:
+            shards.append((first_id, location_id))
+            first_id, devices = None, 0
+    if first_id is not None:
+        shards.append((first_id, location_id))
+    return shards
+
+
+def run_sharded(name, shard_task):
+    """
+    Runs :shard_task: for every device shard in parallel and summarizes the results with summarize_shards.
+    Skipped while the previous run is in progress: the shards renew its lease and summarize_shards releases it.
+    """
+    from hub.models import Log
+    lease = TaskLease(name)
+    if not lease.acquire():
+        run_skipped(name)
+        return
+    run_started(name)
+    shards = device_shards()
+    Log.objects.create(type='n', tag=name, message="Dispatching %d shards" % len(shards))
+    if shards:
+        chord(shard_task.s(first_id, last_id, lease.token) for first_id, last_id in shards)(
+            summarize_shards.s(name, lease.token))
+    else:
+        run_finished(name)
+        lease.release()
+
+
+def run_shard(shard_task, name, first_id, last_id, function, token=None):
+    """
+    Runs :function: over a shard, retrying on errors. A shard that keeps failing is reported instead of
+    failing the whole chord.
+    :return: {"shard": [first_id, last_id], "processed": number of processed devices, "failed": bool}
+    """
+    from hub.models import Log
+    try:
+        with TaskLease(name, token).heartbeat():
+            processed = function(first_id, last_id)
+    except Exception as exc:
+        if shard_task.request.retries < shard_task.max_retries:
+            raise shard_task.retry(exc=exc)
+        Log.objects.create(type='e', tag=name, message="Shard %d-%d failed: %r" % (first_id, last_id, exc))
+        return {"shard": [first_id, last_id], "processed": 0, "failed": True}
+    return {"shard": [first_id, last_id], "processed": processed, "failed": False}
+
+
+@task(name="summarize_shards")
+def summarize_shards(results, name, token=None):
+    from hub.models import Log
+    failed = ["%d-%d" % tuple(result["shard"]) for result in results if result["failed"]]
+    processed = sum(result["processed"] for result in results)
+    message = "Finished: %d shards, %d devices processed" % (len(results), processed)
+    if failed:
+        message += ", failed shards: %s" % ", ".join(failed)
+    lease = TaskLease(name, token)
+    if not run_finished(name, failed=bool(failed), message=message, lease=lease):
+        Log.objects.create(type='w', tag=name, message="Ignored, the lease of this run has expired. " + message)
+        return processed
+    Log.objects.create(type='w' if failed else 'n', tag=name, message=message)
+    lease.release()
+    return processed
+
+
+@task(name="calculate_averages", ignore_result=True)
 def calculate_averages():
     """
     Calculate daily average readouts
     """
+    run_sharded("calculate_averages", calculate_averages_shard)
+
+
+@task(bind=True, name="calculate_averages_shard", max_retries=3, default_retry_delay=60)
+def calculate_averages_shard(self, first_id, last_id, token=None):
+    return run_shard(self, "calculate_averages", first_id, last_id, _calculate_averages, token)
+
+
+def _calculate_averages(first_id, last_id):
+    """
+    Time-weighted daily averages: a value counts for the time until the next readout, so the changes-only
+    readouts of deadband locations average the same as full ones
+    """
     from hub.models import Readout, Log, Device, AverageReadout
+    from hub.deadband import time_weighted_means
+    from hub.routers import use_replica
+    from django.db import IntegrityError, transaction
     from django.db.models import Q
-    from django.db.models import Avg
 
-    devices = Device.objects.filter(location__isnull=False)
+    columns = ('timestamp', 'temp', 'humid', 'CO2', 'charge')
+    devices = Device.objects.filter(location_id__range=(first_id, last_id)).select_related('location')
     for device in devices:
+        # A value holds until the device counts as lost (see check_devices), plus the heartbeat for deadband
+        max_hold = device.sleep_period / 1000 * 2.5
+        if device.location.deadband:
+            max_hold += device.location.deadband_heartbeat
         date = datetime.now()
         while True:
             day_beginning = datetime(date.year, date.month, date.day)
             day_ending = day_beginning + timedelta(hours=23, minutes=59, seconds=59)
-            aver = AverageReadout.objects.filter(device=device, location=device.location,
-                                                 timestamp__exact=day_beginning)
-            if aver:
+            # By (device, timestamp) like the unique key, the device may have moved since
+            if AverageReadout.objects.filter(device=device, timestamp=day_beginning).exists():
                 break
-            readouts = Readout.objects.filter(
-                Q(device=device) & Q(timestamp__range=[day_beginning, day_ending]) & Q(temp__isnull=False))
-            if not readouts:
+            readouts = Readout.objects.filter(Q(device=device) & Q(temp__isnull=False), averagereadout__isnull=True)
+            with use_replica():
+                rows = list(readouts.filter(timestamp__range=[day_beginning, day_ending])
+                            .order_by('timestamp').values_list(*columns))
+                if not rows:
+                    break
+                previous = readouts.filter(timestamp__lt=day_beginning).values_list(*columns).first() \
+                    if device.location.deadband else None
+
+            temp, humid, CO2, charge = (round(mean, 1) if mean is not None else None for mean in
+                                        time_weighted_means(rows, day_beginning + timedelta(days=1), max_hold,
+                                                            previous, day_beginning))
+
+            try:
+                with transaction.atomic():
+                    AverageReadout.objects.create(device=device, location=device.location, timestamp=day_beginning,
+                                                  temp=temp, humid=humid, CO2=CO2, charge=charge)
+            except IntegrityError:
+                # The slot is taken by a readout stored exactly at midnight, stop instead of walking further
+                # back through the device's history every night
+                Log.objects.create(type='w', tag="calculate_averages",
+                                   message="No average for device %d on %s: (device, timestamp) is taken" % (
+                                       device.id, day_beginning.date()))
                 break
-            averages = {}
-            averages.update(readouts.aggregate(Avg('temp')))
-            averages.update(readouts.aggregate(Avg('humid')))
-            averages.update(readouts.aggregate(Avg('CO2')))
-            averages.update(readouts.aggregate(Avg('charge')))
-
-            temp = round(averages["temp__avg"], 1) if averages["temp__avg"] is not None else None
-            humid = round(averages["humid__avg"], 1) if averages["humid__avg"] is not None else None
-            CO2 = round(averages["CO2__avg"], 1) if averages["CO2__avg"] is not None else None
-            charge = round(averages["charge__avg"], 1) if averages["charge__avg"] is not None else None
-
-            AverageReadout.objects.create(device=device, location=device.location, timestamp=day_beginning, temp=temp,
-                                          humid=humid, CO2=CO2, charge=charge)
             date -= timedelta(days=1)
+    return len(devices)
 
 
-@periodic_task(run_every=(crontab(minute='*/30')), name="check_devices", ignore_result=True)
+@task(name="check_devices", ignore_result=True)
 def check_devices():
-    from hub.models import Device, Alert, Log
     logger.info("Checking devices")
-    print("Checking devices")
-    Log.objects.create(type='n', tag="check_devices", message="Searching of outdated devices started")
-    devices = Device.objects.filter(location__isnull=False)
+    run_sharded("check_devices", check_devices_shard)
+
+
+@task(bind=True, name="check_devices_shard", max_retries=3, default_retry_delay=10)
+def check_devices_shard(self, first_id, last_id, token=None):
+    return run_shard(self, "check_devices", first_id, last_id, _check_devices, token)
+
+
+def _check_devices(first_id, last_id):
+    from hub.models import Device, Alert, Log
+    devices = Device.objects.filter(last_connection__isnull=False, location_id__range=(first_id, last_id))
     t_now = datetime.now().timestamp()
     for device in devices:
         l_c = device.last_connection.timestamp()
-        print(device, device.last_connection, t_now - l_c, (device.sleep_period / 1000) * 2.5)
         if t_now - l_c > (device.sleep_period / 1000) * 2.5:
             alert, created = Alert.objects.get_or_create(location=device.location, type='o', critical=True)
             if not created:
@@ -97,6 +208,230 @@ def check_devices():
             alert.save()
             device.warning = 2
             device.save()
+    return len(devices)
+
+
+@task(name="detect_anomalies", ignore_result=True)
+@single_flight("detect_anomalies")
+def detect_anomalies():
+    """
+    Searches the recent history of all locations for spikes, stuck sensors and slow drifts
+    """
+    from hub.models import Alert, Log
+    from hub.anomalies import detect
+    from hub.routers import use_replica
+
+    Log.objects.create(type='n', tag="detect_anomalies", message="Searching for anomalies started")
+    with use_replica():
+        anomalies = detect()
+    alerts = {alert.location_id: alert for alert in
+              Alert.objects.filter(location_id__in=anomalies.keys(), type='a').select_related('location')}
+    for location_id, found in anomalies.items():
+        alert = alerts.get(location_id)
+        if alert is None:
+            alert = Alert(location_id=location_id, type='a')
+        else:
+            alert.counter += 1
+        alert.message = "Аномалия в [%s]: %s" % (alert.location, "; ".join(found))
+        alert.timestamp = datetime.now()
+        alert.save()
+        Log.objects.create(type='w', tag="detect_anomalies", message=alert.message)
+
+
+UPTIME_SQL = """
+WITH devices AS (
+    -- Deadband locations store a readout at least every heartbeat while nothing changes
+    SELECT d.id, d.sleep_period, CASE WHEN l.deadband THEN l.deadband_heartbeat ELSE 0 END AS heartbeat
+    FROM hub_device d
+    JOIN hub_location l ON l.id = d.location_id
+), points AS (
+    SELECT r.device_id, r.timestamp AS moment, TRUE AS in_day
+    FROM hub_readout r
+    LEFT JOIN hub_averagereadout a ON a.readout_ptr_id = r.id
+    WHERE a.readout_ptr_id IS NULL AND r.device_id IS NOT NULL AND r.timestamp >= %(start)s AND r.timestamp < %(end)s
+    UNION ALL
+    -- The last readout before the day, the day start if there is none
+    SELECT d.id, COALESCE((SELECT r.timestamp FROM hub_readout r
+                           WHERE r.device_id = d.id AND r.timestamp < %(start)s
+                             AND NOT EXISTS (SELECT 1 FROM hub_averagereadout a WHERE a.readout_ptr_id = r.id)
+                           ORDER BY r.timestamp DESC LIMIT 1), %(start)s), FALSE
+    FROM devices d
+    UNION ALL
+    -- The first readout after the day, now if there is none yet
+    SELECT d.id, COALESCE((SELECT r.timestamp FROM hub_readout r
+                           WHERE r.device_id = d.id AND r.timestamp >= %(end)s
+                             AND NOT EXISTS (SELECT 1 FROM hub_averagereadout a WHERE a.readout_ptr_id = r.id)
+                           ORDER BY r.timestamp LIMIT 1), %(now)s), FALSE
+    FROM devices d
+), gaps AS (
+    SELECT device_id, in_day, moment AS ending,
+           LAG(moment) OVER (PARTITION BY device_id ORDER BY moment, in_day) AS beginning
+    FROM points
+), intervals AS (
+    SELECT g.device_id, g.in_day, g.beginning, g.ending,
+           GREATEST(CASE WHEN EXTRACT(HOUR FROM g.beginning) BETWEEN 8 AND 23 THEN d.sleep_period
+                         ELSE GREATEST(d.sleep_period, %(night)s) END / 1000.0, d.heartbeat) AS period
+    FROM gaps g
+    JOIN devices d ON d.id = g.device_id
+    WHERE g.beginning IS NOT NULL
+), clipped AS (
+    -- The part of every gap within the day, and of its downtime: the time after the next readout was due
+    SELECT device_id, in_day,
+           EXTRACT(EPOCH FROM ending - beginning) > %(factor)s * period AS offline,
+           EXTRACT(EPOCH FROM LEAST(ending, %(end)s) - GREATEST(beginning, %(start)s)) AS gap,
+           GREATEST(EXTRACT(EPOCH FROM LEAST(ending, %(end)s) -
+                                       GREATEST(beginning + period * INTERVAL '1 second', %(start)s)), 0) AS downtime
+    FROM intervals
+)
+SELECT device_id, COUNT(*) FILTER (WHERE in_day),
+       COUNT(*) FILTER (WHERE offline AND gap > 0),
+       COALESCE(MAX(gap) FILTER (WHERE offline), 0),
+       COALESCE(SUM(downtime) FILTER (WHERE offline), 0)
+FROM clipped
+GROUP BY device_id
+"""
+
+
+def expected_readouts(sleep_period):
+    """
+    Readouts a device should send in a day following the day/night schedule of process_readout
+    :param sleep_period: in ms
+    """
+    return int(16 * 3600000 / sleep_period + 8 * 3600000 / max(sleep_period, DEVICE_NIGHT_SLEEP_TIME))
+
+
+@task(name="calculate_uptime", ignore_result=True)
+@single_flight("calculate_uptime")
+def calculate_uptime():
+    """
+    Materializes daily device uptime for every complete day since the last run.
+    Gaps are found with LAG() over the readout timestamps of every device and clipped to the day, so an outage
+    spanning midnight counts for both days and one starting before the day is found however long it lasts.
+    Devices of deadband locations are expected to store a readout every heartbeat, their received readouts
+    come from the ingest counters (DeviceReception) like those of the other devices.
+    """
+    from hub.models import Readout, Device, DeviceUptime, DeviceReception, Log
+    from hub.routers import use_replica, read_database
+    from django.db import connections, transaction
+    from django.db.models import Max, Min
+
+    last = DeviceUptime.objects.aggregate(Max('date'))['date__max']
+    if last is not None:
+        day = datetime(last.year, last.month, last.day) + timedelta(days=1)
+    else:
+        first = Readout.objects.aggregate(Min('timestamp'))['timestamp__min']
+        if first is None:
+            return
+        day = datetime(first.year, first.month, first.day)
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    Log.objects.create(type='n', tag="calculate_uptime", message="Calculating uptime since %s" % day.date())
+    while day < today:
+        params = {'start': day, 'end': day + timedelta(days=1), 'now': datetime.now(),
+                  'night': DEVICE_NIGHT_SLEEP_TIME, 'factor': UPTIME_GAP_FACTOR}
+        with use_replica(), connections[read_database()].cursor() as cursor:
+            cursor.execute(UPTIME_SQL, params)
+            stats = {row[0]: row[1:] for row in cursor.fetchall()}
+        # Days before the counters were introduced keep the number of stored readouts
+        counted = dict(DeviceReception.objects.filter(date=day.date()).values_list('device_id', 'received'))
+        with transaction.atomic():
+            uptimes = []
+            for device_id, sleep_period in Device.objects.filter(location__isnull=False).values_list('id',
+                                                                                                    'sleep_period'):
+                received, gaps, longest_gap, downtime = stats.get(device_id, (0, 1, 86400, 86400))
+                received = counted.get(device_id, received)
+                uptimes.append(DeviceUptime(device_id=device_id, date=day.date(),
+                                            expected=expected_readouts(sleep_period), received=received, gaps=gaps,
+                                            longest_gap=longest_gap, downtime=min(downtime, 86400)))
+            DeviceUptime.objects.bulk_create(uptimes)
+        day += timedelta(days=1)
+
+
+AREA_ROLLUP_SQL = """
+INSERT INTO hub_areaaggregate (building, floor, timestamp, locations, readouts, temp_mean, temp_min, temp_max,
+                               humid_mean, humid_min, humid_max, "CO2_mean", "CO2_min", "CO2_max", alerting_locations)
+SELECT l.building, l.floor, date_trunc('hour', r.timestamp), COUNT(DISTINCT r.location_id), COUNT(*),
+       AVG(r.temp), MIN(r.temp), MAX(r.temp), AVG(r.humid), MIN(r.humid), MAX(r.humid),
+       AVG(r."CO2"), MIN(r."CO2"), MAX(r."CO2"),
+       COUNT(DISTINCT r.location_id) FILTER (WHERE ABS(r.temp - CASE
+           WHEN EXTRACT(MONTH FROM r.timestamp) IN (1, 2, 3, 10, 11, 12) THEN l.cold_season_normal_temp
+           ELSE l.warm_season_normal_temp END) > l.max_temp_deviation)
+FROM hub_readout r
+JOIN hub_location l ON l.id = r.location_id
+LEFT JOIN hub_averagereadout a ON a.readout_ptr_id = r.id
+WHERE a.readout_ptr_id IS NULL AND r.timestamp >= %(start)s
+GROUP BY GROUPING SETS ((l.building, l.floor, date_trunc('hour', r.timestamp)),
+                        (l.building, date_trunc('hour', r.timestamp)))
+HAVING GROUPING(l.floor) = 1 OR l.floor IS NOT NULL
+"""
+
+
+@task(name="rollup_areas", ignore_result=True)
+@single_flight("rollup_areas")
+def rollup_areas():
+    """
+    Recomputes the hourly building and floor aggregates (AreaAggregate) from the last stored hour on,
+    so late readouts of the previous hour are included. Starts AREA_ROLLUP_BACKFILL_DAYS ago on the first run.
+    Both levels come from one scan of the readouts with GROUPING SETS.
+    """
+    from hub.models import AreaAggregate
+    from django.db import connection, transaction
+    from django.db.models import Max
+
+    last = AreaAggregate.objects.aggregate(Max('timestamp'))['timestamp__max']
+    if last is None:
+        start = datetime.now() - timedelta(days=AREA_ROLLUP_BACKFILL_DAYS)
+        start = start.replace(minute=0, second=0, microsecond=0)
+    else:
+        start = last - timedelta(hours=1)
+    with transaction.atomic():
+        AreaAggregate.objects.filter(timestamp__gte=start).delete()
+        with connection.cursor() as cursor:
+            cursor.execute(AREA_ROLLUP_SQL, {'start': start})
+
+
+@task(name="forecast_battery", ignore_result=True)
+@single_flight("forecast_battery")
+def forecast_battery():
+    """
+    Predicts battery depletion dates of all devices and warns about the ones running out soon
+    """
+    from hub.models import Device, Alert, Log
+    from hub.forecast import forecast_depletion
+    from hub.routers import use_replica
+
+    Log.objects.create(type='n', tag="forecast_battery", message="Battery forecast started")
+    with use_replica():
+        forecast = forecast_depletion()
+    warn_before = datetime.now() + timedelta(days=BATTERY_FORECAST_ALERT_DAYS)
+    devices = Device.objects.filter(id__in=forecast.keys()).select_related('location')
+    # The device running out first in each location, None if no device there runs out soon
+    urgent = {}
+    for device in devices:
+        depletion_date = forecast[device.id]
+        if device.depletion_date != depletion_date:
+            Device.objects.filter(id=device.id).update(depletion_date=depletion_date)
+        if device.location_id is None:
+            continue
+        current = urgent.setdefault(device.location_id, None)
+        if depletion_date is not None and depletion_date <= warn_before and (
+                current is None or depletion_date < forecast[current.id]):
+            urgent[device.location_id] = device
+    for location_id, device in urgent.items():
+        if device is None:
+            # Forecast alerts are not critical, the critical one is managed by process_readout
+            Alert.objects.filter(location_id=location_id, type='b', critical=False).delete()
+            continue
+        alert, created = Alert.objects.get_or_create(location_id=location_id, type='b')
+        if alert.critical:
+            continue
+        if not created:
+            alert.counter += 1
+        alert.timestamp = datetime.now()
+        alert.message = "Батарея устройства, расположенного в [%s], разрядится примерно %s (%1.1f%%)" % (
+            device.location, forecast[device.id].strftime("%d.%m.%Y %H:%M"), device.battery_level())
+        Log.objects.create(type='w', tag="forecast_battery", message=alert.message)
+        alert.save()
 
 
 def season():
@@ -108,6 +443,15 @@ def season():
     return 0 if month in {1, 2, 3, 10, 11, 12} else 1
 
 
+def default_sleep_time() -> int:
+    """
+    Sleep time for devices without alerts: longer at night
+    """
+    if datetime.now().time().hour in range(8, 24):
+        return DEVICE_DEFAULT_SLEEP_TIME
+    return DEVICE_NIGHT_SLEEP_TIME
+
+
 def process_readout(readout) -> int:
     from hub.models import Alert, Log
 
@@ -115,10 +459,7 @@ def process_readout(readout) -> int:
     if isinstance(readout, list):
         readout = readout[-1]  # The last element - the newest element
     # Temperature check
-    if datetime.now().time().hour in range(8, 24):
-        sleep_time = DEVICE_DEFAULT_SLEEP_TIME
-    else:
-        sleep_time = DEVICE_NIGHT_SLEEP_TIME
+    sleep_time = default_sleep_time()
 
     if readout.temp is None:
         return sleep_time
@@ -158,7 +499,7 @@ def process_readout(readout) -> int:
         readout.device.save()
 
     # Battery check
-    if readout.device.battery_level() <= 0.1:
+    if readout.device.battery_level() <= BATTERY_EMPTY_LEVEL:
         alert, created = Alert.objects.get_or_create(location=location, type='b')
         critical = True
         alert.timestamp = readout.timestamp
@@ -174,7 +515,8 @@ def process_readout(readout) -> int:
             alert.counter += 1
         alert.save()
     else:
-        alert = Alert.objects.filter(location=location, type='b')
+        # Non-critical battery alerts come from forecast_battery
+        alert = Alert.objects.filter(location=location, type='b', critical=True)
         alert.delete()
     sync_alert = Alert.objects.filter(location=location, type='o')
     sync_alert.delete()
@@ -184,6 +526,8 @@ def process_readout(readout) -> int:
 @task(name="send_email_task")
 def async_send_mail(title, message, alert_id, sender_id):
     from hub.models import Alert, Log
+    from django.core.mail import EmailMultiAlternatives
+    from django.template.loader import render_to_string
     Log.objects.create(type='n', tag="async_send_mail",
                        message='Sending email. Title: "%s" Text: "%s" Alert: %d Sender: %d' % (
                            title, message, alert_id, sender_id))
@@ -247,7 +591,118 @@ def async_generate_year_readouts(device, location):
 
 @task(name="remove_all_readouts_from_location")
 def async_remove_all_readouts_from_location(location):
-    from hub.models import Readout
-    r = Readout.objects.filter(location_id=location)
-    r.delete()
+    """
+    Deletes the history of a location in batches, see run_decommission
+    """
+    from hub.models import DecommissionJob
+    job = DecommissionJob.objects.create(location_id=location, mode='d')
+    run_decommission(job.id)
     return True
+
+
+@task(name="run_decommission", ignore_result=True)
+def run_decommission(job_id):
+    """
+    Archives or deletes the readouts, daily averages and alerts of a DecommissionJob's location in batches
+    in (timestamp, id) order. Every batch is committed together with the job progress, so an interrupted job
+    resumes after its last batch. Only one worker runs a job at a time; pausing it in the admin stops it after
+    the current batch.
+    """
+    from hub.models import DecommissionJob, Readout, Log
+
+    lease = TaskLease("decommission_%d" % job_id)
+    if not lease.acquire():
+        return
+    try:
+        with lease.heartbeat():
+            job = DecommissionJob.objects.filter(id=job_id, status__in=('q', 'r')).first()
+            if job is None:
+                return
+            if job.total is None:
+                job.total = Readout.objects.filter(location_id=job.location_id, timestamp__lte=job.created).count()
+            job.status = 'r'
+            job.save()
+            Log.objects.create(type='n', tag="decommission", message="Started %s" % job)
+
+            while _decommission_batch(job):
+                if DecommissionJob.objects.filter(id=job.id).values_list('status', flat=True).first() != 'r':
+                    Log.objects.create(type='n', tag="decommission", message="Paused %s" % job)
+                    return
+                time.sleep(job.batch_delay)
+            _decommission_alerts(job)
+
+            DecommissionJob.objects.filter(id=job.id).update(status='d')
+            Log.objects.create(type='n', tag="decommission", message="Finished %s: %d readouts, %d averages, "
+                                                                      "%d alerts" % (job.location_name, job.readouts,
+                                                                                     job.averages, job.alerts))
+    except Exception as exc:
+        DecommissionJob.objects.filter(id=job_id).update(status='f', message=repr(exc))
+        Log.objects.create(type='e', tag="decommission", message="Job %d failed: %r" % (job_id, exc))
+        raise
+    finally:
+        lease.release()
+
+
+def _decommission_batch(job):
+    """
+    Archives (if the job says so) and deletes the next batch of readouts of the job's location.
+    The keyset on (timestamp, id) walks the (location, timestamp) index without revisiting deleted rows.
+    :return: False when nothing is left
+    """
+    from hub.models import Readout, ArchivedReadout, DecommissionJob
+    from django.db import connection, transaction
+    from django.db.models import Q
+
+    readouts = Readout.objects.filter(location_id=job.location_id, timestamp__lte=job.created)
+    if job.last_id is not None:
+        readouts = readouts.filter(Q(timestamp__gt=job.last_timestamp) |
+                                   Q(timestamp=job.last_timestamp, id__gt=job.last_id))
+    rows = list(readouts.order_by('timestamp', 'id').values_list(
+        'id', 'timestamp', 'device_id', 'charge', 'temp', 'CO2', 'humid', 'averagereadout')[:job.batch_size])
+    if not rows:
+        return False
+    ids = [row[0] for row in rows]
+    averages = [row[0] for row in rows if row[7] is not None]
+
+    with transaction.atomic():
+        if job.mode == 'a':
+            ArchivedReadout.objects.bulk_create([
+                ArchivedReadout(original_id=pk, timestamp=timestamp, device_id=device_id, location_id=job.location_id,
+                                charge=charge, temp=temp, CO2=CO2, humid=humid, average=average is not None, job=job)
+                for pk, timestamp, device_id, charge, temp, CO2, humid, average in rows])
+        with connection.cursor() as cursor:
+            if averages:
+                cursor.execute("DELETE FROM hub_averagereadout WHERE readout_ptr_id = ANY(%s)", [averages])
+            cursor.execute("DELETE FROM hub_readout WHERE id = ANY(%s)", [ids])
+        job.readouts += len(ids) - len(averages)
+        job.averages += len(averages)
+        job.last_timestamp, job.last_id = rows[-1][1], rows[-1][0]
+        DecommissionJob.objects.filter(id=job.id).update(readouts=job.readouts, averages=job.averages,
+                                                         last_timestamp=job.last_timestamp, last_id=job.last_id)
+    return True
+
+
+def _decommission_alerts(job):
+    from hub.models import Alert, ArchivedAlert, DecommissionJob
+    from django.db import transaction
+
+    with transaction.atomic():
+        alerts = list(Alert.objects.select_for_update().filter(location_id=job.location_id))
+        if job.mode == 'a':
+            ArchivedAlert.objects.bulk_create([
+                ArchivedAlert(original_id=alert.id, timestamp=alert.timestamp, location_id=job.location_id,
+                              type=alert.type, critical=alert.critical, message=alert.message, counter=alert.counter,
+                              email_sent=alert.email_sent, job=job) for alert in alerts])
+        Alert.objects.filter(id__in=[alert.id for alert in alerts]).delete()
+        job.alerts += len(alerts)
+        DecommissionJob.objects.filter(id=job.id).update(alerts=job.alerts)
+
+
+@task(name="resume_decommissions", ignore_result=True)
+def resume_decommissions():
+    """
+    Restarts queued and running decommission jobs whose worker is gone (running ones just skip)
+    """
+    from hub.models import DecommissionJob
+    for job_id in DecommissionJob.objects.filter(status__in=('q', 'r')).values_list('id', flat=True):
+        run_decommission.delay(job_id)
@@ -1,3 +1,385 @@
-from django.test import TestCase
+import asyncio
+import json
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, connections, OperationalError
+from django.http import HttpResponse
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, RequestFactory
+from django.urls import resolve
+
+from hub.benchmarks import measure_startup
+from hub import routers
+from hub.ingest import BatchWriter, insert_readouts, process_uploads
+from hub.models import Location, Device, Readout, AverageReadout, DeviceReception
+from hub.middleware import ReplicaRoutingMiddleware, PRIMARY_COOKIE
+from hub.routers import ReplicaRouter, use_replica, read_database, replica_lag
+from hub.tasks import default_sleep_time
+from hub.udp import ReadoutProtocol, pack_record, unpack_reply, STATUS_OK
+
+
+class StartupTimeTest(SimpleTestCase):
+    def assertWithinBudget(self, process):
+        # The best of a few runs, so a busy machine does not fail the test
+        setup = min(measure_startup(process)['setup'] for _ in range(3))
+        self.assertLessEqual(setup, settings.STARTUP_TIME_BUDGET[process],
+                             "%s process setup took %.3f s" % (process, setup))
+
+    def test_web_startup(self):
+        self.assertWithinBudget('web')
+
+    def test_web_setup_skips_task_machinery(self):
+        # Tasks, locks, task hooks and NumPy are imported on demand by the views that need them
+        self.assertEqual(measure_startup('web')['loaded'], [])
+
+    def test_worker_startup(self):
+        self.assertWithinBudget('worker')
+
+
+class IngestTest(TestCase):
+    """
+    Readouts are stored once per (device, timestamp), see hub.ingest
+    """
+
+    def setUp(self):
+        location = Location.objects.create(building='un', floor=1, room=101, warm_season_normal_temp=22,
+                                           cold_season_normal_temp=22)
+        self.device = Device.objects.create(MAC="02:00:00:00:00:01", location=location, allow_untrusted=True)
+        self.other = Device.objects.create(MAC="02:00:00:00:00:02", location=location, allow_untrusted=True)
+        self.start = datetime(2018, 7, 1, 12, 0, 0)
+
+    def readout(self, device, minutes, temp=22.0):
+        return Readout(device=device, location=device.location, timestamp=self.start + timedelta(minutes=minutes),
+                       charge=4.0, temp=temp)
+
+    def upload(self, device, minutes=None, temp=22.0):
+        data = {'device': device.id, 'charge': 4.0, 'temp': temp}
+        if minutes is not None:
+            data['timestamp'] = (self.start + timedelta(minutes=minutes)).isoformat()
+        return data
+
+    def assertIdsMatch(self, inserted):
+        for readout in inserted:
+            stored = Readout.objects.get(device=readout.device, timestamp=readout.timestamp)
+            self.assertEqual(readout.id, stored.id)
+            self.assertEqual(readout.temp, stored.temp)
+
+    def test_insert_returns_ids_of_new_rows(self):
+        readouts = [self.readout(device, minutes, temp=20 + minutes) for minutes in range(3)
+                    for device in (self.device, self.other)]
+        inserted = insert_readouts(readouts)
+        self.assertEqual(len(inserted), 6)
+        self.assertIdsMatch(inserted)
+
+    def test_insert_skips_stored_readouts(self):
+        insert_readouts([self.readout(self.device, 0), self.readout(self.device, 1)])
+        inserted = insert_readouts([self.readout(self.device, minutes, temp=25) for minutes in range(4)])
+        self.assertEqual([readout.timestamp for readout in inserted],
+                         [self.start + timedelta(minutes=2), self.start + timedelta(minutes=3)])
+        self.assertIdsMatch(inserted)
+        self.assertEqual(Readout.objects.filter(device=self.device).count(), 4)
+        # The stored values are not overwritten by the retry
+        self.assertEqual(Readout.objects.get(device=self.device, timestamp=self.start).temp, 22.0)
+
+    def test_insert_keeps_first_duplicate_of_a_batch(self):
+        inserted = insert_readouts([self.readout(self.device, 0, temp=21), self.readout(self.device, 0, temp=23),
+                                    self.readout(self.other, 0)])
+        self.assertEqual(len(inserted), 2)
+        self.assertEqual(Readout.objects.get(device=self.device).temp, 21)
+
+    def test_insert_without_postgresql(self):
+        with mock.patch.object(connection, 'vendor', 'sqlite'):
+            insert_readouts([self.readout(self.device, 0)])
+            inserted = insert_readouts([self.readout(self.device, 0), self.readout(self.device, 1),
+                                        self.readout(self.device, 1), self.readout(self.other, 0)])
+        self.assertEqual(len(inserted), 2)
+        self.assertIdsMatch(inserted)
+        self.assertEqual(Readout.objects.count(), 3)
+
+    def test_upload_counts(self):
+        batch = [self.upload(self.device, minutes) for minutes in range(3)]
+        (status, _, headers), = process_uploads([batch])
+        self.assertEqual(status, 201)
+        self.assertEqual(headers, {'X-Readouts-Accepted': '3', 'X-Readouts-Duplicate': '0'})
+
+        # A retry with one new readout
+        (status, body, headers), = process_uploads([batch + [self.upload(self.device, 3)]])
+        self.assertEqual(status, 201)
+        self.assertEqual(headers, {'X-Readouts-Accepted': '1', 'X-Readouts-Duplicate': '3'})
+        self.assertEqual(Readout.objects.filter(device=self.device).count(), 4)
+
+        # Only duplicates: the default sleep time, alert rules are not run again
+        (status, body, headers), = process_uploads([batch])
+        self.assertEqual(headers, {'X-Readouts-Accepted': '0', 'X-Readouts-Duplicate': '3'})
+        self.assertEqual(body, str(default_sleep_time()))
+
+    def test_uploads_of_one_batch_are_counted_separately(self):
+        results = process_uploads([self.upload(self.device, 0), [self.upload(self.device, 0),
+                                                                 self.upload(self.device, 1)],
+                                   {'device': self.other.id}])
+        self.assertEqual([result[0] for result in results], [201, 201, 400])
+        self.assertEqual(results[0][2], {'X-Readouts-Accepted': '1', 'X-Readouts-Duplicate': '0'})
+        self.assertEqual(results[1][2], {'X-Readouts-Accepted': '1', 'X-Readouts-Duplicate': '1'})
+
+    def test_batch_without_timestamps_is_one_readout(self):
+        # Readouts without a timestamp are taken now, a batch of them stores only the first
+        (status, _, headers), = process_uploads([[self.upload(self.device, temp=temp) for temp in (21, 22, 23)]])
+        self.assertEqual(status, 201)
+        self.assertEqual(headers, {'X-Readouts-Accepted': '1', 'X-Readouts-Duplicate': '2'})
+        self.assertEqual(Readout.objects.get(device=self.device).temp, 21)
+
+    def test_retried_deadband_drops_are_received_once(self):
+        Location.objects.filter(id=self.device.location_id).update(deadband=True)
+        batch = [self.upload(self.device, minutes) for minutes in range(3)]
+        # The last readout is sent twice in the same upload
+        process_uploads([batch + [self.upload(self.device, 2)]])
+        self.assertEqual(Readout.objects.filter(device=self.device).count(), 1)
+        self.assertEqual(DeviceReception.objects.get(device=self.device).received, 3)
+
+        process_uploads([batch])
+        process_uploads([batch + [self.upload(self.device, 3)]])
+        self.assertEqual(DeviceReception.objects.get(device=self.device).received, 4)
+
+        with mock.patch.object(connection, 'vendor', 'sqlite'):
+            process_uploads([batch + [self.upload(self.device, 3), self.upload(self.device, 4)]])
+        self.assertEqual(DeviceReception.objects.get(device=self.device).received, 5)
+
+
+class UrlConfTest(SimpleTestCase):
+    def test_urlconf_imports(self):
+        # Fails on errors in any view module evaluated at import time
+        self.assertEqual(resolve('/api/readouts/').url_name, 'readout-list')
+        self.assertEqual(resolve('/api/devices/1/battery/').url_name, 'device-battery')
+
+
+class ColumnarTest(TestCase):
+    def setUp(self):
+        User.objects.create_user('staff', password='secret')
+        self.client.login(username='staff', password='secret')
+        self.location = Location.objects.create(building='un', floor=1, room=101)
+        now = datetime.now().replace(microsecond=0)
+        for minutes in (30, 20, 10):
+            Readout.objects.create(location=self.location, timestamp=now - timedelta(minutes=minutes), charge=4.0,
+                                   temp=22.0 + minutes / 10)
+        self.timestamps = [int((now - timedelta(minutes=minutes)).timestamp()) for minutes in (10, 20, 30)]
+
+    def get(self, **params):
+        response = self.client.get('/api/readouts/', dict(location=self.location.id, period='today',
+                                                           format='columnar', **params))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode())
+
+    def test_columns(self):
+        data = self.get()
+        self.assertNotIn('delta', data)
+        self.assertEqual(data['timestamp'], self.timestamps)
+        self.assertEqual(data['temp'], [23.0, 24.0, 25.0])
+        self.assertEqual(data['CO2'], [None] * 3)
+
+    def test_delta_columns(self):
+        data = self.get(delta=1)
+        self.assertTrue(data['delta'])
+        self.assertEqual(data['timestamp'], [self.timestamps[0], -600, -600])
+
+
+class DeduplicateReadoutsTest(TestCase):
+    def setUp(self):
+        # The data the command cleans up predates the (device, timestamp) constraint, dropped for the test
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT conname FROM pg_constraint WHERE conrelid = 'hub_readout'::regclass "
+                           "AND contype = 'u'")
+            for name, in cursor.fetchall():
+                cursor.execute('ALTER TABLE hub_readout DROP CONSTRAINT "%s"' % name)
+        self.old = Location.objects.create(building='un', floor=1, room=101)
+        self.new = Location.objects.create(building='un', floor=2, room=201)
+        self.device = Device.objects.create(MAC="02:00:00:00:00:01", location=self.new)
+        self.midnight = datetime(2018, 7, 1)
+
+    def average(self, location, temp):
+        return AverageReadout.objects.create(device=self.device, location=location, timestamp=self.midnight,
+                                             charge=4.0, temp=temp)
+
+    def raw(self, timestamp, temp=22.0):
+        return Readout.objects.create(device=self.device, location=self.new, timestamp=timestamp, charge=4.0,
+                                      temp=temp)
+
+    def test_keeps_first_readout(self):
+        first = self.raw(self.midnight + timedelta(hours=1))
+        self.raw(self.midnight + timedelta(hours=1), temp=25)
+        call_command('deduplicate_readouts', delay=0, stdout=StringIO())
+        self.assertEqual(list(Readout.objects.values_list('id', flat=True)), [first.id])
+
+    def test_keeps_newest_average(self):
+        # Stored again for the new location after the device moved
+        self.average(self.old, 21.0)
+        newest = self.average(self.new, 23.0)
+        call_command('deduplicate_readouts', delay=0, stdout=StringIO())
+        self.assertEqual(list(AverageReadout.objects.values_list('id', flat=True)), [newest.id])
+        self.assertEqual(Readout.objects.count(), 1)
+
+    def test_moves_readout_off_average(self):
+        average = self.average(self.new, 22.0)
+        raw = self.raw(self.midnight, temp=24.0)
+        call_command('deduplicate_readouts', delay=0, stdout=StringIO())
+        raw.refresh_from_db()
+        self.assertEqual(raw.timestamp, self.midnight + timedelta(seconds=1))
+        self.assertEqual(AverageReadout.objects.get().id, average.id)
+
+    def test_removes_readout_off_average_without_free_slot(self):
+        self.average(self.new, 22.0)
+        self.raw(self.midnight, temp=24.0)
+        taken = self.raw(self.midnight + timedelta(seconds=1))
+        call_command('deduplicate_readouts', delay=0, stdout=StringIO())
+        self.assertEqual(list(Readout.objects.filter(averagereadout__isnull=True).values_list('id', flat=True)),
+                         [taken.id])
+
+
+class UdpIngestTest(TransactionTestCase):
+    """
+    Datagrams sent to the listener on 127.0.0.1, stored by the BatchWriter thread (hence committed data)
+    """
+    key = "test key"
+
+    def setUp(self):
+        location = Location.objects.create(building='un', floor=1, room=101)
+        self.device = Device.objects.create(MAC="02:00:00:00:00:01", location=location, allow_untrusted=True)
+        self.loop = asyncio.new_event_loop()
+        self.writer = BatchWriter(self.loop, batch_size=10, batch_delay=0.01)
+        self.transport, _ = self.loop.run_until_complete(self.loop.create_datagram_endpoint(
+            lambda: ReadoutProtocol(self.writer, self.key, 600), local_addr=('127.0.0.1', 0)))
+        self.port = self.transport.get_extra_info('sockname')[1]
+        self.task = self.loop.create_task(self.writer.run())
+
+    def tearDown(self):
+        self.task.cancel()
+        self.transport.close()
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        self.writer.executor.shutdown()
+        self.loop.close()
+
+    def exchange(self, datagram, timeout=2.0):
+        """
+        :return: the reply to :datagram:, None if there is none within :timeout: seconds
+        """
+        loop = self.loop
+        reply = loop.create_future()
+
+        class Client(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                if not reply.done():
+                    reply.set_result(data)
+
+        async def send():
+            transport, _ = await loop.create_datagram_endpoint(Client, remote_addr=('127.0.0.1', self.port))
+            transport.sendto(datagram)
+            try:
+                return await asyncio.wait_for(reply, timeout, loop=loop)
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                transport.close()
+
+        return loop.run_until_complete(send())
+
+    def test_readout_is_stored(self):
+        timestamp = datetime.now().replace(microsecond=0)
+        reply = self.exchange(pack_record(self.key, self.device.id, 4.0, temp=22.5, timestamp=timestamp))
+        device_id, status, sleep_time = unpack_reply(reply)
+        self.assertEqual((device_id, status), (self.device.id, STATUS_OK))
+        self.assertGreater(sleep_time, 0)
+        readout = Readout.objects.get(device=self.device)
+        self.assertEqual((readout.timestamp, readout.temp, readout.CO2), (timestamp, 22.5, None))
+
+    def test_bad_signature_is_dropped(self):
+        self.assertIsNone(self.exchange(pack_record("other key", self.device.id, 4.0, temp=22.5), timeout=0.5))
+        self.assertFalse(Readout.objects.exists())
+
+    def test_replay_adds_nothing(self):
+        datagram = pack_record(self.key, self.device.id, 4.0, temp=22.5)
+        self.assertIsNotNone(self.exchange(datagram))
+        # A retry or replay within the window repeats the stored (device, timestamp)
+        self.assertIsNotNone(self.exchange(datagram))
+        self.assertEqual(Readout.objects.filter(device=self.device).count(), 1)
+
+    def test_outdated_record_is_dropped(self):
+        datagram = pack_record(self.key, self.device.id, 4.0, temp=22.5,
+                               timestamp=datetime.now() - timedelta(hours=1))
+        self.assertIsNone(self.exchange(datagram, timeout=0.5))
+        self.assertFalse(Readout.objects.exists())
+
+
+class ReplicaRoutingTest(TransactionTestCase):
+    """
+    Uses the replica of the test settings, a mirror of the test database (TransactionTestCase so that
+    its connection sees the data)
+    """
+    multi_db = True
+
+    def setUp(self):
+        routers._lag.clear()
+        self.location = Location.objects.create(building='un', floor=1, room=101)
+
+    def tearDown(self):
+        routers._lag.clear()
+
+    def test_reads_in_use_replica_go_to_replica(self):
+        self.assertEqual(Location.objects.all().db, 'default')
+        with use_replica():
+            self.assertEqual(Location.objects.all().db, 'replica')
+            self.assertEqual(read_database(), 'replica')
+            self.assertEqual(Location.objects.get().id, self.location.id)
+            # Writes always go to the primary
+            self.assertEqual(ReplicaRouter().db_for_write(Location), 'default')
+        self.assertEqual(read_database(), 'default')
+
+    def test_lagging_replica_falls_back_to_primary(self):
+        with mock.patch('hub.routers.replica_lag', return_value=settings.REPLICA_MAX_LAG + 1), use_replica():
+            self.assertEqual(Location.objects.all().db, 'default')
+            self.assertEqual(read_database(), 'default')
+
+    def test_unreachable_replica_falls_back_to_primary(self):
+        with mock.patch.object(connections['replica'], 'cursor', side_effect=OperationalError), use_replica():
+            self.assertEqual(replica_lag('replica'), float('inf'))
+            self.assertEqual(Location.objects.all().db, 'default')
+
+
+class ReplicaRoutingMiddlewareTest(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.status = 200
+        self.routed = None
+
+    def get_response(self, request):
+        # Where the view's reads would go
+        self.routed = ReplicaRouter().db_for_read(None) or 'default'
+        return HttpResponse(status=self.status)
+
+    def request(self, request):
+        with mock.patch('hub.routers.replica_lag', return_value=0):
+            return ReplicaRoutingMiddleware(self.get_response)(request)
+
+    def test_safe_api_requests_read_from_replica(self):
+        self.request(self.factory.get('/api/readouts/'))
+        self.assertEqual(self.routed, 'replica')
+        self.request(self.factory.get('/admin/'))
+        self.assertEqual(self.routed, 'default')
+
+    def test_reads_stick_to_primary_after_write(self):
+        response = self.request(self.factory.post('/api/readouts/'))
+        self.assertEqual(self.routed, 'default')
+        cookie = response.cookies[PRIMARY_COOKIE]
+        self.assertEqual(cookie['max-age'], settings.REPLICA_STICKY_SECONDS)
+
+        request = self.factory.get('/api/readouts/')
+        request.COOKIES[PRIMARY_COOKIE] = cookie.value
+        self.request(request)
+        self.assertEqual(self.routed, 'default')
+
+    def test_failed_write_does_not_stick(self):
+        self.status = 400
+        response = self.request(self.factory.post('/api/readouts/'))
+        self.assertNotIn(PRIMARY_COOKIE, response.cookies)
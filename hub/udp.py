@@ -0,0 +1,95 @@
+import asyncio
+import hashlib
+import hmac
+import math
+import struct
+from datetime import datetime
+from functools import partial
+
+# Readout datagram, network byte order: device id, unix timestamp, charge, temp, CO2, humid (NaN - no such sensor),
+# followed by TAG_SIZE bytes of HMAC-SHA256 of the record with UDP_INGEST_KEY.
+# Records are accepted only within UDP_INGEST_WINDOW seconds of their timestamp, and a replay within that time
+# repeats a stored (device, timestamp), so a captured datagram can not add readouts.
+RECORD = struct.Struct('!IIffff')
+TAG_SIZE = 8
+# Reply: device id, status, sleep time in ms
+REPLY = struct.Struct('!IBI')
+
+STATUS_OK = 0
+STATUS_REJECTED = 1
+
+
+def sign(key, record):
+    return hmac.new(key.encode(), record, hashlib.sha256).digest()[:TAG_SIZE]
+
+
+def pack_record(key, device_id, charge, temp=None, CO2=None, humid=None, timestamp=None):
+    """
+    Builds a readout datagram the way devices do
+    :param timestamp: datetime of the readout, now if None
+    """
+    nan = float('nan')
+    record = RECORD.pack(device_id, int((timestamp or datetime.now()).timestamp()), charge,
+                         nan if temp is None else temp, nan if CO2 is None else CO2, nan if humid is None else humid)
+    return record + sign(key, record)
+
+
+def unpack_record(key, datagram, window, now=None):
+    """
+    :param window: seconds a record may be older or newer than :now:
+    :return: readout data for ReadoutCreateSerializer, None if the datagram is malformed, not signed with :key:
+             or its timestamp is outside the window
+    """
+    if len(datagram) != RECORD.size + TAG_SIZE:
+        return None
+    record, tag = datagram[:RECORD.size], datagram[RECORD.size:]
+    if not hmac.compare_digest(sign(key, record), tag):
+        return None
+    device_id, timestamp, charge, temp, CO2, humid = RECORD.unpack(record)
+    if abs(timestamp - (now or datetime.now()).timestamp()) > window:
+        return None
+    # float32 noise is cut off, sensors are not more precise anyway
+    data = {'device': device_id, 'charge': round(charge, 3), 'timestamp': datetime.fromtimestamp(timestamp)}
+    for name, value in (('temp', temp), ('CO2', CO2), ('humid', humid)):
+        if not math.isnan(value):
+            data[name] = round(value, 3)
+    return data
+
+
+def unpack_reply(datagram):
+    """
+    :return: (device id, status, sleep time in ms)
+    """
+    return REPLY.unpack(datagram)
+
+
+class ReadoutProtocol(asyncio.DatagramProtocol):
+    """
+    Receives signed readout datagrams, stores them through a BatchWriter and replies with the sleep time.
+    Malformed, unsigned and outdated datagrams are dropped without a reply.
+    """
+
+    def __init__(self, writer, key, window):
+        self.writer = writer
+        self.key = key
+        self.window = window
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, datagram, addr):
+        data = unpack_record(self.key, datagram, self.window)
+        if data is None:
+            return
+        future = self.writer.submit(data)
+        future.add_done_callback(partial(self.reply, data['device'], addr))
+
+    def reply(self, device_id, addr, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        status, body, _ = future.result()
+        if status == 201:
+            self.transport.sendto(REPLY.pack(device_id, STATUS_OK, int(body)), addr)
+        else:
+            self.transport.sendto(REPLY.pack(device_id, STATUS_REJECTED, 0), addr)
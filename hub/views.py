@@ -1,25 +1,29 @@
+import time
 from datetime import timedelta, datetime
 
-from django.conf import settings
 from django.contrib import auth
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth.models import User, Group
 from django.db.models import Q
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse
 from django.shortcuts import render, redirect
-from django.utils.crypto import get_random_string
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
-
-from ClimateBox.settings import HUB_SECRET_KEY_LENGTH, DEVICE_DEFAULT_SLEEP_TIME
-from hub.models import Readout, Device, Alert, Log, AverageReadout
+from rest_framework.settings import api_settings
+
+from ClimateBox.settings import DEVICE_DEFAULT_SLEEP_TIME
+from hub.metrics import REQUEST_LATENCY, export
+from hub.deadband import step_series
+from hub.models import Readout, Device, Alert, Log, AverageReadout, DeviceUptime, Location, AreaAggregate
+from hub.pagination import TimestampCursorPagination, IdCursorPagination, LogCursorPagination
+from hub.renderers import ColumnarRenderer, is_columnar, columns, representation, list_response
 from hub.serializers import UserSerializer, GroupSerializer, ReadoutListSerializer, ReadoutCreateSerializer, \
-    DeviceListSerializer, DeviceCreateSerializer, BatteryReadoutListSerializer, AlertListSerializer
-from hub.tasks import remove_old_alerts, check_devices, process_readout, async_send_mail, async_generate_year_readouts, \
-    async_remove_all_readouts_from_location, calculate_averages
+    DeviceListSerializer, DeviceCreateSerializer, BatteryReadoutListSerializer, AlertListSerializer, \
+    DeviceUptimeListSerializer, LogListSerializer
+from hub.state import registration_key, consume_registration_key
 
 
 @login_required
@@ -30,7 +34,26 @@ def index(request):
 @login_required
 @staff_member_required
 def secret_key(request):
-    return JsonResponse({'key': settings.hub_secret_key})
+    return JsonResponse({'key': registration_key()})
+
+
+def metrics(request):
+    body, content_type = export()
+    return HttpResponse(body, content_type=content_type)
+
+
+class MetricsMixin(object):
+    """
+    Records the latency of every request per viewset action
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        start = time.time()
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            action = getattr(self, 'action', None) or request.method.lower()
+            REQUEST_LATENCY.labels(self.__class__.__name__, action).observe(time.time() - start)
 
 
 class UserViewSet(viewsets.ModelViewSet):
@@ -52,10 +75,12 @@ class GroupViewSet(viewsets.ModelViewSet):
 periods = {None: 0, "today": 1, "week": 7, "month": 30, "year": 365}
 
 
-class ReadoutViewSet(viewsets.ModelViewSet):
+class ReadoutViewSet(MetricsMixin, viewsets.ModelViewSet):
     """
     list:
-    Show readouts by given location and time period. GET params: location=id, period=[today, week, month, year] (if none - returns latest readout)
+    Show readouts by given location and time period. GET params: location=id, period=[today, week, month, year] (if none - returns latest readout),
+    page_size, cursor (page through full resolution readouts of the period, newest first),
+    format=columnar (parallel arrays with epoch second timestamps), delta=1 (columnar timestamps as differences)
 
     create:
     Send new readout.
@@ -75,6 +100,9 @@ class ReadoutViewSet(viewsets.ModelViewSet):
 
         location = request.query_params.get('location', None)
         period = request.query_params.get('period', None)
+        columnar, delta_encoded = is_columnar(request), request.query_params.get('delta') in ('1', 'true')
+        fields = ReadoutListSerializer.Meta.fields
+        rows = None
 
         if period is None:
             latest = Readout.objects.filter(Q(location=location) & Q(temp__isnull=False))
@@ -88,45 +116,52 @@ class ReadoutViewSet(viewsets.ModelViewSet):
             end_date = start_date - timedelta(days=delta)
             queryset = Readout.objects.filter(
                 Q(location=location) & Q(timestamp__range=[end_date, start_date]) & Q(temp__isnull=False))
+            raw = queryset.filter(averagereadout__isnull=True)
+            page = self.paginate_queryset(raw.values('id', *fields))
+            if page is not None:
+                if columnar:
+                    return self.get_paginated_response(columns(page, fields, delta_encoded))
+                return self.get_paginated_response(representation(page, fields))
             if queryset.count() > 600:
                 queryset = AverageReadout.objects.filter(
                 Q(location=location) & Q(timestamp__range=[end_date, start_date]) & Q(temp__isnull=False))
+            elif Location.objects.filter(id=location, deadband=True).exists():
+                # Only changes are stored, every value holds until the next one
+                previous = Readout.objects.filter(
+                    Q(location=location) & Q(timestamp__lt=end_date) & Q(temp__isnull=False),
+                    averagereadout__isnull=True).values_list(*fields).first()
+                rows = step_series(raw.values_list(*fields), previous, end_date, start_date)
 
-        serializer = self.get_serializer(queryset, many=True)
+        if rows is None:
+            rows = queryset.values_list(*fields)
+        if columnar:
+            return Response(columns(rows, fields, delta_encoded))
 
-        return Response(serializer.data)
+        # Same output as the list serializer, without building model instances
+        return list_response(request, rows, fields)
 
     def create(self, request, *args, **kwargs):
+        from hub.ingest import evaluate_readouts, upload_headers
         is_many = True if isinstance(request.data, list) else False
         serializer = self.get_serializer(data=request.data, many=is_many)
         serializer.is_valid(raise_exception=True)
-        self.perform_create(serializer)
+        readouts, duplicates = self.perform_create(serializer)
         headers = self.get_success_headers(serializer.data)
-        new_sleep_time = process_readout(serializer.instance)
+        headers.update(upload_headers(readouts, duplicates))
+        new_sleep_time = evaluate_readouts(readouts)
         return Response(str(new_sleep_time), status=status.HTTP_201_CREATED, headers=headers)
 
     def perform_create(self, serializer):
-        try:
-            many = serializer.many
-        except AttributeError:
-            many = False
-        data = serializer.validated_data
-        print(many)
-        if many:
-            device = data[-1]['device']
-        else:
-            device = data['device']
-        location = device.location
-        # Log.objects.create(type='n', tag="readout_create", message="Creating new readout. Bulk: %s. Data: %s. Data[-1]: %s" % (many, data, data[-1] if many else ""))	
-        if "timestamp" in data or many:
-            serializer.save(location=location)
-        else:
-            serializer.save(location=location, timestamp=datetime.now())
-        print(serializer)
-        device.last_connection = datetime.now()
-        device.last_readout_id = serializer.instance.id if not many else serializer.instance[-1].id
-        device.charge = serializer.instance.charge if not many else serializer.instance[-1].charge
-        device.save()
+        """
+        :return: (stored readouts, number of duplicates skipped)
+        """
+        from hub.ingest import store_readouts
+        readouts, duplicates = store_readouts([serializer])[0]
+        if isinstance(serializer.validated_data, list):
+            serializer.instance = readouts
+        elif readouts:
+            serializer.instance = readouts[0]
+        return readouts, duplicates
 
     def retrieve(self, request, *args, **kwargs):
         return Response(status=status.HTTP_405_METHOD_NOT_ALLOWED)
@@ -136,9 +171,11 @@ class ReadoutViewSet(viewsets.ModelViewSet):
 
     queryset = Readout.objects.all()
     permission_classes = ()
+    pagination_class = TimestampCursorPagination
+    renderer_classes = tuple(api_settings.DEFAULT_RENDERER_CLASSES) + (ColumnarRenderer,)
 
 
-class DeviceViewSet(viewsets.ModelViewSet):
+class DeviceViewSet(MetricsMixin, viewsets.ModelViewSet):
     """
     list:
     Show all located devices (location is not None)
@@ -150,7 +187,11 @@ class DeviceViewSet(viewsets.ModelViewSet):
     Get device details
 
     battery:
-    Get battery readouts for given device id. GET params: period=[today, week, month, year]
+    Get battery readouts for given device id. GET params: period=[today, week, month, year], page_size, cursor,
+    format=columnar, delta=1 (as for readouts)
+
+    uptime:
+    Get daily uptime (received/expected readouts, gaps, downtime) for given device id. GET params: period=[week, month, year]
     """
     http_method_names = ['get', 'post', 'options']
 
@@ -161,6 +202,8 @@ class DeviceViewSet(viewsets.ModelViewSet):
             return DeviceCreateSerializer
         if self.action == 'battery':
             return BatteryReadoutListSerializer
+        if self.action == 'uptime':
+            return DeviceUptimeListSerializer
         return DeviceListSerializer
 
     def list(self, request, *args, **kwarg):
@@ -174,6 +217,8 @@ class DeviceViewSet(viewsets.ModelViewSet):
     @action(detail=True, permission_classes=[permissions.IsAuthenticated, ])
     def battery(self, request, pk=None):
         period = request.query_params.get('period', None)
+        columnar, delta_encoded = is_columnar(request), request.query_params.get('delta') in ('1', 'true')
+        fields = BatteryReadoutListSerializer.Meta.fields
         if period is None:
             latest = Readout.objects.filter(device_id=pk)
             if latest:
@@ -186,24 +231,46 @@ class DeviceViewSet(viewsets.ModelViewSet):
             end_date = start_date - timedelta(days=delta)
             queryset = Readout.objects.filter(
                 Q(device_id=pk) & Q(timestamp__range=[end_date, start_date]))
+            raw = queryset.filter(averagereadout__isnull=True)
+            page = self.paginate_queryset(raw.values('id', *fields))
+            if page is not None:
+                if columnar:
+                    return self.get_paginated_response(columns(page, fields, delta_encoded))
+                return self.get_paginated_response(representation(page, fields))
             if queryset.count() > 600:
                 queryset = AverageReadout.objects.filter(
                     Q(device_id=pk) & Q(timestamp__range=[end_date, start_date]))
 
+        if columnar:
+            return Response(columns(queryset.values(*fields), fields, delta_encoded))
+
+        # Same output as the list serializer, without building model instances
+        return list_response(request, queryset.values_list(*fields), fields)
+
+    @action(detail=True, permission_classes=[permissions.IsAuthenticated, ])
+    def uptime(self, request, pk=None):
+        period = request.query_params.get('period', 'week')
+        if period not in periods:
+            return Response("Bad period", status=status.HTTP_400_BAD_REQUEST)
+        end_date = datetime.now().date()
+        queryset = DeviceUptime.objects.filter(device_id=pk, date__gte=end_date - timedelta(days=periods[period]))
+
         serializer = self.get_serializer(queryset, many=True)
 
         return Response(serializer.data)
 
     def create(self, request, *args, **kwargs):
-        key = self.request.data["key"]
-        if not key == settings.hub_secret_key:
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        # Used up only by a valid request, a malformed one keeps the key for the retry
+        key = self.request.data.get("key")
+        if not consume_registration_key(key):
             print(request.META)
             Log.objects.create(type='e', tag="device_registration",
                                message="Attempt to register with bad key; " + str(request.META))
             return Response("Bad key", status=status.HTTP_403_FORBIDDEN)
 
-        serializer = self.get_serializer(data=request.data)
-        serializer.is_valid(raise_exception=True)
         device = Device.objects.filter(MAC=serializer.validated_data["MAC"])
         if device:
             device = device.first()
@@ -218,7 +285,6 @@ class DeviceViewSet(viewsets.ModelViewSet):
             ret_status = status.HTTP_201_CREATED
             Log.objects.create(type='n', tag="device_registration",
                                message="Created new device %s" % device.MAC)
-        settings.hub_secret_key = get_random_string(length=HUB_SECRET_KEY_LENGTH).upper()
 
         return Response(str(device.id) + "," + str(device.sleep_period), status=ret_status)
 
@@ -232,17 +298,21 @@ class DeviceViewSet(viewsets.ModelViewSet):
 
     queryset = Device.objects.all()
     permission_classes = ()
+    pagination_class = TimestampCursorPagination
+    renderer_classes = tuple(api_settings.DEFAULT_RENDERER_CLASSES) + (ColumnarRenderer,)
 
 
-class AlertViewSet(viewsets.ModelViewSet):
+class AlertViewSet(MetricsMixin, viewsets.ModelViewSet):
     """
     list:
-
+    Show alerts. GET params: location=id, page_size, cursor
     """
     http_method_names = ['get', 'options']
     queryset = Alert.objects.all()
     serializer_class = AlertListSerializer
     permission_classes = (IsAuthenticated,)
+    # Alert.timestamp can be NULL
+    pagination_class = IdCursorPagination
 
     def list(self, request, *args, **kwarg):
         location = request.query_params.get('location', None)
@@ -252,6 +322,11 @@ class AlertViewSet(viewsets.ModelViewSet):
         else:
             queryset = Alert.objects.filter(location_id=location)
 
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+
         serializer = self.get_serializer(queryset, many=True)
 
         return Response(serializer.data)
@@ -273,9 +348,93 @@ class AlertViewSet(viewsets.ModelViewSet):
             return Response("Alert not found", status=status.HTTP_404_NOT_FOUND)
 
 
+class LogViewSet(MetricsMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    list:
+    Show service log, newest first. GET params: type=[n, w, e], tag, page_size (100 by default), cursor
+    """
+    queryset = Log.objects.all()
+    serializer_class = LogListSerializer
+    permission_classes = (permissions.IsAdminUser,)
+    pagination_class = LogCursorPagination
+
+    def get_queryset(self):
+        queryset = Log.objects.all()
+        log_type = self.request.query_params.get('type', None)
+        tag = self.request.query_params.get('tag', None)
+        if log_type is not None:
+            queryset = queryset.filter(type=log_type)
+        if tag is not None:
+            queryset = queryset.filter(tag=tag)
+        return queryset
+
+
+class AnalyticsViewSet(MetricsMixin, viewsets.ViewSet):
+    """
+    list:
+    Min/max/mean/95th percentile of temperature, humidity and CO2 per group over a time period.
+    GET params: group=[location, floor, building] (location by default), period=[today, week, month, year] (today by default),
+    source=[raw, averages] (raw readouts for today and week, daily averages for longer periods by default)
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def list(self, request, *args, **kwargs):
+        from hub.analytics import location_statistics, groupings
+        group = request.query_params.get('group', 'location')
+        period = request.query_params.get('period', 'today')
+        if group not in groupings or period not in periods:
+            return Response("Bad group or period", status=status.HTTP_400_BAD_REQUEST)
+        source = request.query_params.get('source', 'raw' if periods[period] <= periods['week'] else 'averages')
+        if source not in ('raw', 'averages'):
+            return Response("Bad source", status=status.HTTP_400_BAD_REQUEST)
+
+        end_date = datetime.now()
+        start_date = end_date - timedelta(days=periods[period])
+        return Response(location_statistics(group, start_date, end_date, source))
+
+
+class BuildingViewSet(MetricsMixin, viewsets.ViewSet):
+    """
+    list:
+    Hourly mean/min/max of temperature, humidity and CO2 of a building or one of its floors, the number of
+    locations reporting and of locations where the temperature left the norm, newest first.
+    GET params: building, floor (the whole building if none), period=[today, week, month, year] (today by default,
+    latest hour if empty), format=columnar, delta=1 (as for readouts)
+    """
+    permission_classes = (IsAuthenticated,)
+    renderer_classes = tuple(api_settings.DEFAULT_RENDERER_CLASSES) + (ColumnarRenderer,)
+    fields = ('timestamp', 'locations', 'readouts', 'temp_mean', 'temp_min', 'temp_max', 'humid_mean', 'humid_min',
+              'humid_max', 'CO2_mean', 'CO2_min', 'CO2_max', 'alerting_locations')
+
+    def list(self, request, *args, **kwargs):
+        building = request.query_params.get('building')
+        floor = request.query_params.get('floor')
+        period = request.query_params.get('period', 'today') or None
+        if building not in dict(Location.buildings_list) or period not in periods:
+            return Response("Bad building or period", status=status.HTTP_400_BAD_REQUEST)
+        try:
+            floor = int(floor) if floor else None
+        except ValueError:
+            return Response("Bad floor", status=status.HTTP_400_BAD_REQUEST)
+
+        queryset = AreaAggregate.objects.filter(building=building, floor=floor) if floor is not None \
+            else AreaAggregate.objects.filter(building=building, floor__isnull=True)
+        if period is None:
+            queryset = queryset[:1]
+        else:
+            queryset = queryset.filter(timestamp__gte=datetime.now() - timedelta(days=periods[period]))
+
+        rows = queryset.values_list(*self.fields)
+        if is_columnar(request):
+            return Response(columns(rows, self.fields, request.query_params.get('delta') in ('1', 'true')))
+        return list_response(request, rows, self.fields)
+
+
 @login_required
 @user_passes_test(lambda u: u.is_superuser)
 def debug_interface(request):
+    from hub.tasks import remove_old_alerts, check_devices, async_send_mail, async_generate_year_readouts, \
+        async_remove_all_readouts_from_location, calculate_averages
     task = request.GET["task"]
     print(task)
     if task == '0':